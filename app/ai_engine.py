@@ -1,8 +1,18 @@
 import google.generativeai as genai
-from PIL import Image
+from PIL import Image, ImageOps
 from io import BytesIO
+import asyncio
+import hashlib
+import json
 import logging
+import re
+from difflib import SequenceMatcher
+import threading
+from textwrap import dedent
+from typing import List
+from app.cache import TTLCache, DiskCache
 from app.config import get_settings
+from app.concurrency import describe_limiter, embed_limiter, verify_limiter, chat_limiter, embed_rate_limiter, run_image_task
 
 settings = get_settings()
 logger = logging.getLogger("OmniVision")
@@ -10,122 +20,445 @@ logger = logging.getLogger("OmniVision")
 # Configure Gemini
 genai.configure(api_key=settings.GEMINI_API_KEY)
 
-def process_image(image_bytes: bytes):
+# --- Prompts (parsed once at import) ---
+
+DESCRIBE_PROMPT = dedent("""
+    Describe the MAIN PRODUCT in this image.
+    If there is a person/model, IGNORE the person and focus ONLY on the item they are wearing or holding (e.g., Watch, Shirt, Bag, Shoes).
+    If there are multiple items, describe the most prominent fashion accessory or clothing item.
+    Focus on: Category, Color, Material, Pattern, and Style.
+    Be concise but specific.
+""").strip()
+
+VERIFY_PROMPT = dedent("""
+    Compare these two images. Are they the EXACT same product model?
+    IGNORE any people, models, or body parts (wrists, hands).
+    Ignore lighting, angle, or minor wear.
+    Focus on:
+    1. Shape (Round vs Square)
+    2. Dial details (Markers, Hands, Sub-dials)
+    3. Strap style
+
+    Return ONLY a number from 0 to 100 representing the probability they are the same product.
+    0 = Different product.
+    100 = Exact same product.
+""").strip()
+
+TEXT_VERIFY_PROMPT = dedent("""
+    Two product descriptions follow. Do they describe the EXACT same product model?
+    Focus on category, color, material, pattern, shape and distinctive details.
+
+    Description A:
+    {query}
+
+    Description B:
+    {candidate}
+
+    Return ONLY a number from 0 to 100 representing the probability they are the same product.
+""").strip()
+
+CHAT_SYSTEM_INSTRUCTION = dedent("""
+    You are a helpful AI shopping assistant for a shop.
+    Your goal is to help customers find products and answer questions about the shop.
+    Be polite, concise, and helpful.
+    If the user asks about products, encourage them to send an image.
+""").strip()
+
+# Bump when a prompt changes meaningfully so cached results for the old prompt are not reused
+DESCRIBE_PROMPT_VERSION = "1"
+VERIFY_PROMPT_VERSION = "1"
+
+_SCORE_PATTERN = re.compile(r'\d+')
+
+# --- Model handles (one per role, built once per worker) ---
+
+ROLE_DESCRIBE = "describe"
+ROLE_VERIFY = "verify"
+ROLE_CHAT = "chat"
+
+_HARM_CATEGORIES = (
+    "HARM_CATEGORY_HARASSMENT",
+    "HARM_CATEGORY_HATE_SPEECH",
+    "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+    "HARM_CATEGORY_DANGEROUS_CONTENT",
+)
+
+_models = {}
+
+def _build_model(role: str) -> genai.GenerativeModel:
+    if role == ROLE_DESCRIBE:
+        max_tokens, temperature, threshold = settings.DESCRIBE_MAX_OUTPUT_TOKENS, settings.DESCRIBE_TEMPERATURE, settings.DESCRIBE_SAFETY_THRESHOLD
+    elif role == ROLE_VERIFY:
+        max_tokens, temperature, threshold = settings.VERIFY_MAX_OUTPUT_TOKENS, settings.VERIFY_TEMPERATURE, settings.VERIFY_SAFETY_THRESHOLD
+    elif role == ROLE_CHAT:
+        max_tokens, temperature, threshold = settings.CHAT_MAX_OUTPUT_TOKENS, settings.CHAT_TEMPERATURE, settings.CHAT_SAFETY_THRESHOLD
+    else:
+        raise ValueError(f"Unknown model role: {role}")
+
+    safety_settings = {category: threshold for category in _HARM_CATEGORIES} if threshold else None
+    return genai.GenerativeModel(
+        settings.GEMINI_MODEL,
+        generation_config=genai.GenerationConfig(max_output_tokens=max_tokens, temperature=temperature),
+        safety_settings=safety_settings,
+        system_instruction=CHAT_SYSTEM_INSTRUCTION if role == ROLE_CHAT else None,
+    )
+
+def _get_model(role: str) -> genai.GenerativeModel:
+    model = _models.get(role)
+    if model is None:
+        model = _models[role] = _build_model(role)
+    return model
+
+def load_models():
+    """Builds the describe/verify/chat model handles up front (called on startup)."""
+    for role in (ROLE_DESCRIBE, ROLE_VERIFY, ROLE_CHAT):
+        _get_model(role)
+
+# --- Request building / response parsing (shared by the sync and async entry points) ---
+
+def _embedding_request(description) -> dict:
+    # `description` may also be a list of texts, which the SDK sends as one batch request
+    # We embed the description to get a semantic vector.
+    return {
+        "model": settings.GEMINI_EMBEDDING_MODEL,
+        "content": description,
+        "task_type": "retrieval_document",
+        "title": "Product Description",
+    }
+
+def _image_result(description: str, embedding: list, image_digest: str, image: dict) -> dict:
+    return {
+        "embedding": embedding,        # 768 dims
+        "description": description,
+        "image_hash": image_digest,    # sha256 of the prepared image
+        "image": image                 # the prepared image, reused for verification
+    }
+
+def _failed_image_result() -> dict:
+    # Return zero vectors on failure
+    return {
+        "embedding": [0.0] * 768
+    }
+
+def _parse_score(text: str) -> int:
+    match = _SCORE_PATTERN.search(text.strip())
+    if match:
+        score = int(match.group())
+        logger.info("Visual Verification Score: %s", score)
+        return score
+    return 0
+
+def _chat_prompt(message: str, context: str) -> str:
+    # The fixed assistant instructions live on the chat model handle; only shop context varies per call.
+    prompt = f"User: {message}\nAssistant:"
+    if context:
+        prompt = f"Shop Context/Rules:\n{context}\n\n{prompt}"
+    return prompt
+
+# --- Image preprocessing ---
+
+_ENCODINGS = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+# Cumulative counters for this worker
+image_prep_stats = {"images": 0, "bytes_in": 0, "bytes_out": 0}
+_image_prep_lock = threading.Lock()
+
+def prepare_image(image_bytes: bytes) -> dict:
+    """
+    Normalizes an image before it is sent to Gemini and returns it as an inline image part:
+    applies EXIF orientation, flattens transparency onto white, downsizes to IMAGE_MAX_EDGE (JPEGs
+    are decoded in draft mode at a reduced scale), drops all metadata and re-encodes to IMAGE_FORMAT
+    at IMAGE_QUALITY.
+    Blocking (PIL), so the async pipeline runs it on the dedicated image executor.
+    """
+    max_edge = settings.IMAGE_MAX_EDGE
+    image_format = settings.IMAGE_FORMAT.upper()
+    mime_type = _ENCODINGS.get(image_format)
+    if mime_type is None:
+        raise ValueError(f"Unsupported IMAGE_FORMAT: {settings.IMAGE_FORMAT}")
+
+    image = Image.open(BytesIO(image_bytes))
+    if image.format == "JPEG":
+        # Let libjpeg decode at 1/2, 1/4 or 1/8 scale, still at least max_edge on both sides
+        image.draft("RGB", (max_edge, max_edge))
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        # Flatten onto white; convert("RGB") would turn transparent areas black or garbage
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    # A fresh encode without exif/icc arguments carries no metadata
+    buffer = BytesIO()
+    image.save(buffer, format=image_format, quality=settings.IMAGE_QUALITY)
+    data = buffer.getvalue()
+
+    with _image_prep_lock:
+        image_prep_stats["images"] += 1
+        image_prep_stats["bytes_in"] += len(image_bytes)
+        image_prep_stats["bytes_out"] += len(data)
+    logger.info("Image prepared: %sx%s, %s -> %s bytes (%s saved)", image.size[0], image.size[1], len(image_bytes), len(data), len(image_bytes) - len(data))
+    return {"mime_type": mime_type, "data": data}
+
+def image_prep_metrics() -> dict:
+    return {**image_prep_stats, "bytes_saved": image_prep_stats["bytes_in"] - image_prep_stats["bytes_out"]}
+
+# --- process_image result cache ---
+# Keyed by the hash of the *prepared* image bytes, so re-uploads and forwarded copies of the same
+# photo hit even if the original files differ in metadata. Failed (zero-vector) results are not cached.
+
+_result_cache = TTLCache(maxsize=settings.RESULT_CACHE_MAX_SIZE, ttl=settings.RESULT_CACHE_TTL)
+_result_disk_cache = (
+    DiskCache(settings.RESULT_CACHE_DIR, max_bytes=settings.RESULT_CACHE_DISK_MAX_BYTES, ttl=settings.RESULT_CACHE_TTL)
+    if settings.RESULT_CACHE_DIR else None
+)
+
+def image_hash(prepared_image: dict) -> str:
+    return hashlib.sha256(prepared_image["data"]).hexdigest()
+
+def _result_cache_key(image_digest: str) -> str:
+    # Model names and prompt version are part of the key, so changing any of them invalidates old entries
+    raw = f"{settings.GEMINI_MODEL}|{settings.GEMINI_EMBEDDING_MODEL}|{DESCRIBE_PROMPT_VERSION}|{image_digest}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def _lookup_result(key: str):
+    """Memory tier first, then disk (blocking). Returns (description, embedding) or None."""
+    cached = _result_cache.get(key)
+    if cached is None and _result_disk_cache is not None:
+        data = _result_disk_cache.get(key)
+        if data is not None:
+            entry = json.loads(data)
+            cached = (entry["description"], entry["embedding"])
+            _result_cache.set(key, cached)
+    return cached
+
+def _store_result(key: str, description: str, embedding: list):
+    _result_cache.set(key, (description, embedding))
+    if _result_disk_cache is not None:
+        _result_disk_cache.set(key, json.dumps({"description": description, "embedding": embedding}).encode())
+
+def result_cache_stats() -> dict:
+    return {
+        "memory": _result_cache.stats(),
+        "disk": _result_disk_cache.stats() if _result_disk_cache is not None else None,
+    }
+
+# --- Verification score cache ---
+# The product image URL is part of the key (uploads get a fresh path), so a replaced image
+# never reuses an old score.
+
+_verify_cache = TTLCache(maxsize=settings.VERIFY_CACHE_MAX_SIZE, ttl=settings.VERIFY_CACHE_TTL)
+
+def verification_cache_key(query_hash: str, product: dict) -> tuple:
+    return (query_hash, product.get("id"), product.get("image_url"), settings.GEMINI_MODEL, VERIFY_PROMPT_VERSION)
+
+def get_cached_verification(cache_key: tuple):
+    """Returns the cached 0-100 score, or None."""
+    return _verify_cache.get(cache_key)
+
+def verify_cache_stats() -> dict:
+    return _verify_cache.stats()
+
+# --- Text verification tier ---
+
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset("""
+    a an and are as at be by for from has have in is it its of on or that the this to with
+    main product image item items shown features featuring appears style design looks
+""".split())
+
+def _description_tokens(text: str) -> set:
+    return {word for word in _WORD_PATTERN.findall(text.lower()) if word not in _STOPWORDS and len(word) > 1}
+
+def description_similarity(query_description: str, candidate_description: str) -> int:
+    """
+    Local 0-100 similarity of two product descriptions: token overlap (Dice) of the content words,
+    blended with a character-level ratio to soften wording differences. No API call.
+    """
+    query_tokens = _description_tokens(query_description)
+    candidate_tokens = _description_tokens(candidate_description)
+    if not query_tokens or not candidate_tokens:
+        return 0
+    dice = 2 * len(query_tokens & candidate_tokens) / (len(query_tokens) + len(candidate_tokens))
+    ratio = SequenceMatcher(None, " ".join(sorted(query_tokens)), " ".join(sorted(candidate_tokens))).ratio()
+    return round(100 * (0.7 * dice + 0.3 * ratio))
+
+async def verify_text_match_async(query_description: str, candidate_description: str) -> int:
+    """Scores two descriptions 0-100, locally or with a text-only Gemini call (TEXT_VERIFY_METHOD)."""
+    if settings.TEXT_VERIFY_METHOD != "gemini":
+        return description_similarity(query_description, candidate_description)
+    try:
+        prompt = TEXT_VERIFY_PROMPT.format(query=query_description, candidate=candidate_description)
+        async with verify_limiter:
+            response = await _get_model(ROLE_VERIFY).generate_content_async(prompt)
+        return _parse_score(response.text)
+    except Exception as e:
+        logger.error("Text Verification Error: %s", e)
+        return description_similarity(query_description, candidate_description)
+
+CHAT_FALLBACK_REPLY = "I'm sorry, I'm having trouble understanding right now. Please try again later."
+
+# --- Pipeline (async; used by the app) ---
+
+async def _lookup_result_async(cache_key: str):
+    if _result_disk_cache is None:
+        return _result_cache.get(cache_key)
+    return await run_image_task(_lookup_result, cache_key)
+
+async def _store_result_async(cache_key: str, description: str, embedding: list):
+    if _result_disk_cache is None:
+        _store_result(cache_key, description, embedding)
+    else:
+        await run_image_task(_store_result, cache_key, description, embedding)
+
+async def _describe_async(image: dict) -> str:
+    async with describe_limiter:
+        response = await _get_model(ROLE_DESCRIBE).generate_content_async([DESCRIBE_PROMPT, image])
+    description = response.text
+    logger.info("Gemini Description: %s", description)
+    return description
+
+async def process_image_async(image_bytes: bytes) -> dict:
     """
     Runs the AI pipeline using Google Gemini:
-    1. Gemini 1.5 Flash: Describes the product in the image.
+    1. Gemini Flash: Describes the product in the image.
     2. Gemini Text Embedding: Embeds the description (768 dims).
     """
     try:
-        # 1. Load Image
-        image = Image.open(BytesIO(image_bytes))
-        
-        # 2. Generate Description (The Eye & The Judge)
-        # We ask Gemini to describe the main product in detail, focusing on visual features.
-        # Using gemini-2.0-flash as it is available in user's account
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        prompt = """
-        Describe the MAIN PRODUCT in this image.
-        If there is a person/model, IGNORE the person and focus ONLY on the item they are wearing or holding (e.g., Watch, Shirt, Bag, Shoes).
-        If there are multiple items, describe the most prominent fashion accessory or clothing item.
-        Focus on: Category, Color, Material, Pattern, and Style.
-        Be concise but specific.
-        """
-        
-        response = model.generate_content([prompt, image])
-        description = response.text
-        logger.info(f"Gemini Description: {description}")
-        
-        # 3. Generate Embedding (The Scout)
-        # We embed the description to get a semantic vector.
-        # Model: models/text-embedding-004 (768 dimensions)
-        emb_result = genai.embed_content(
-            model="models/text-embedding-004",
-            content=description,
-            task_type="retrieval_document",
-            title="Product Description"
-        )
+        image = await run_image_task(prepare_image, image_bytes)
+        image_digest = image_hash(image)
+        cache_key = _result_cache_key(image_digest)
+        cached = await _lookup_result_async(cache_key)
+        if cached is not None:
+            return _image_result(*cached, image_digest, image)
+
+        description = await _describe_async(image)
+
+        async with embed_limiter:
+            emb_result = await genai.embed_content_async(**_embedding_request(description))
         embedding = emb_result['embedding']
-        
-        # 4. Return Result
-        # We use the same embedding for both fields to maintain compatibility with the dual-vector schema structure
-        # (or we could simplify the schema, but let's just duplicate for now to minimize code changes in main.py)
-        return {
-            "siglip_embedding": embedding, # 768 dims
-            "dino_embedding": embedding,   # 768 dims (Duplicate)
-            "description": description     # Optional: Save this if we want
-        }
 
+        await _store_result_async(cache_key, description, embedding)
+        return _image_result(description, embedding, image_digest, image)
     except Exception as e:
-        logger.error(f"Gemini AI Error: {e}")
-        # Return zero vectors on failure
-        return {
-            "siglip_embedding": [0.0] * 768,
-            "dino_embedding": [0.0] * 768
-        }
+        logger.error("Gemini AI Error: %s", e)
+        return _failed_image_result()
 
-def load_models():
-    pass
+# The embedding API accepts at most this many texts per batch request
+EMBED_MAX_BATCH_SIZE = 100
 
-def verify_visual_match(image1_bytes: bytes, image2_bytes: bytes) -> int:
+async def embed_descriptions_async(descriptions: List[str]) -> List[list]:
+    """
+    Embeds many descriptions using batch requests of up to EMBED_BATCH_SIZE texts.
+    Batches run concurrently under the embed limiter and the EMBED_REQUESTS_PER_MINUTE quota;
+    the returned embeddings are in the same order as `descriptions`. Raises on failure.
+    """
+    batch_size = max(1, min(settings.EMBED_BATCH_SIZE, EMBED_MAX_BATCH_SIZE))
+    batches = [descriptions[i:i + batch_size] for i in range(0, len(descriptions), batch_size)]
+
+    async def _embed_batch(batch: List[str]) -> List[list]:
+        await embed_rate_limiter.acquire()
+        async with embed_limiter:
+            result = await genai.embed_content_async(**_embedding_request(batch))
+        embeddings = result['embedding']
+        if len(embeddings) != len(batch):
+            raise RuntimeError(f"Embedding batch returned {len(embeddings)} vectors for {len(batch)} texts")
+        return embeddings
+
+    results = await asyncio.gather(*[_embed_batch(batch) for batch in batches])
+    return [embedding for batch_result in results for embedding in batch_result]
+
+async def describe_prepared_async(image: dict) -> dict:
     """
-    Compares two images using Gemini and returns a similarity score (0-100).
+    Describe step for pipelines that prepare images themselves (see prepare_image).
+    Returns {"description", "image_hash", "embedding"}; "embedding" is only set on a result-cache hit,
+    otherwise embed the description (e.g. with embed_descriptions_async) and call remember_result_async.
+    Raises on failure.
+    """
+    image_digest = image_hash(image)
+    cached = await _lookup_result_async(_result_cache_key(image_digest))
+    if cached is not None:
+        return {"description": cached[0], "image_hash": image_digest, "embedding": cached[1]}
+    return {"description": await _describe_async(image), "image_hash": image_digest, "embedding": None}
+
+async def remember_result_async(image_digest: str, description: str, embedding: list):
+    """Stores a description/embedding pair computed outside process_image_async in the result cache."""
+    await _store_result_async(_result_cache_key(image_digest), description, embedding)
+
+async def verify_visual_match_async(img1: dict, img2: dict, cache_key: tuple = None) -> int:
+    """
+    Compares two prepared images (see prepare_image) using Gemini and returns a similarity score
+    (0-100). Callers pass images they already prepared: the query image from process_image_async
+    and the product image from the product image cache.
+    With a cache_key (see verification_cache_key), a successfully parsed score is cached.
     """
     try:
-        img1 = Image.open(BytesIO(image1_bytes))
-        img2 = Image.open(BytesIO(image2_bytes))
-        
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        prompt = """
-        Compare these two images. Are they the EXACT same product model?
-        IGNORE any people, models, or body parts (wrists, hands).
-        Ignore lighting, angle, or minor wear.
-        Focus on:
-        1. Shape (Round vs Square)
-        2. Dial details (Markers, Hands, Sub-dials)
-        3. Strap style
-        
-        Return ONLY a number from 0 to 100 representing the probability they are the same product.
-        0 = Different product.
-        100 = Exact same product.
-        """
-        
-        response = model.generate_content([prompt, img1, img2])
-        text = response.text.strip()
-        
-        # Extract number
-        import re
-        match = re.search(r'\d+', text)
-        if match:
-            score = int(match.group())
-            logger.info(f"Visual Verification Score: {score}")
-            return score
-        return 0
+        async with verify_limiter:
+            response = await _get_model(ROLE_VERIFY).generate_content_async([VERIFY_PROMPT, img1, img2])
+        score = _parse_score(response.text)
+        if cache_key is not None and _SCORE_PATTERN.search(response.text):
+            _verify_cache.set(cache_key, score)
+        return score
     except Exception as e:
-        logger.error(f"Visual Verification Error: {e}")
+        logger.error("Visual Verification Error: %s", e)
         return 0
 
-def generate_chat_response(message: str, context: str = "") -> str:
+async def generate_chat_response_async(message: str, context: str = "") -> str:
     """
     Generates a chat response using Gemini.
     """
     try:
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        system_instruction = """
-        You are a helpful AI shopping assistant for a shop.
-        Your goal is to help customers find products and answer questions about the shop.
-        Be polite, concise, and helpful.
-        If the user asks about products, encourage them to send an image.
-        """
-        
-        if context:
-            system_instruction += f"\n\nShop Context/Rules:\n{context}"
-            
-        prompt = f"{system_instruction}\n\nUser: {message}\nAssistant:"
-        
-        response = model.generate_content(prompt)
+        async with chat_limiter:
+            response = await _get_model(ROLE_CHAT).generate_content_async(_chat_prompt(message, context))
+        return response.text.strip()
+    except Exception as e:
+        logger.error("Gemini Chat Error: %s", e)
+        return CHAT_FALLBACK_REPLY
+
+# --- Sync wrappers (scripts and callers without an event loop) ---
+
+def process_image(image_bytes: bytes) -> dict:
+    """Blocking version of process_image_async."""
+    try:
+        image = prepare_image(image_bytes)
+        image_digest = image_hash(image)
+        cache_key = _result_cache_key(image_digest)
+        cached = _lookup_result(cache_key)
+        if cached is not None:
+            return _image_result(*cached, image_digest, image)
+
+        response = _get_model(ROLE_DESCRIBE).generate_content([DESCRIBE_PROMPT, image])
+        description = response.text
+        logger.info("Gemini Description: %s", description)
+
+        emb_result = genai.embed_content(**_embedding_request(description))
+        embedding = emb_result['embedding']
+        _store_result(cache_key, description, embedding)
+        return _image_result(description, embedding, image_digest, image)
+    except Exception as e:
+        logger.error("Gemini AI Error: %s", e)
+        return _failed_image_result()
+
+def verify_visual_match(image1_bytes: bytes, image2_bytes: bytes) -> int:
+    """Blocking version of verify_visual_match_async; takes the original image bytes and prepares them."""
+    try:
+        img1 = prepare_image(image1_bytes)
+        img2 = prepare_image(image2_bytes)
+        response = _get_model(ROLE_VERIFY).generate_content([VERIFY_PROMPT, img1, img2])
+        return _parse_score(response.text)
+    except Exception as e:
+        logger.error("Visual Verification Error: %s", e)
+        return 0
+
+def generate_chat_response(message: str, context: str = "") -> str:
+    """Blocking version of generate_chat_response_async."""
+    try:
+        response = _get_model(ROLE_CHAT).generate_content(_chat_prompt(message, context))
         return response.text.strip()
     except Exception as e:
-        logger.error(f"Gemini Chat Error: {e}")
-        return "I'm sorry, I'm having trouble understanding right now. Please try again later."
+        logger.error("Gemini Chat Error: %s", e)
+        return CHAT_FALLBACK_REPLY
@@ -0,0 +1,480 @@
+import asyncio
+import csv
+import io
+import logging
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from app import repository
+from app.ai_engine import prepare_image, describe_prepared_async, embed_descriptions_async, remember_result_async
+from app.concurrency import run_image_task
+from app.config import get_settings
+from app.http_client import get_http_client
+from app.vector_index import vector_index
+
+settings = get_settings()
+logger = logging.getLogger("OmniVision")
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+class BulkImportError(Exception):
+    """Raised for an unusable bulk import request (bad archive, CSV or manifest)."""
+
+# --- Job store ---
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS import_jobs (
+    id TEXT PRIMARY KEY,
+    shop_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS import_items (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    price REAL NOT NULL,
+    source TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    image_url TEXT,
+    product_id TEXT,
+    error TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+"""
+
+class ImportJobStore:
+    """
+    Import jobs and per-item progress in a local SQLite file, so any worker can report on a job
+    and a failed or interrupted import can be resumed from the items that are not done yet.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="import-jobs")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.directory, "jobs.sqlite3"), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    async def _call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io, fn, *args)
+
+    def _create(self, job_id: str, shop_id: int, items: List[dict]):
+        conn = self._connect()
+        conn.execute("BEGIN")
+        conn.execute(
+            "INSERT INTO import_jobs (id, shop_id, status, total, created_at) VALUES (?, ?, 'queued', ?, ?)",
+            (job_id, shop_id, len(items), time.time()),
+        )
+        conn.executemany(
+            "INSERT INTO import_items (job_id, idx, name, price, source) VALUES (?, ?, ?, ?, ?)",
+            [(job_id, i, item["name"], item["price"], item["source"]) for i, item in enumerate(items)],
+        )
+        conn.execute("COMMIT")
+
+    def _get(self, job_id: str) -> Optional[dict]:
+        conn = self._connect()
+        row = conn.execute("SELECT * FROM import_jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM import_items WHERE job_id = ? GROUP BY status", (job_id,)).fetchall())
+        job["items"] = {"pending": counts.get("pending", 0), "done": counts.get("done", 0), "failed": counts.get("failed", 0)}
+        job["errors"] = [
+            dict(r) for r in conn.execute(
+                "SELECT idx, name, error FROM import_items WHERE job_id = ? AND status = 'failed' ORDER BY idx LIMIT 20", (job_id,)
+            ).fetchall()
+        ]
+        return job
+
+    def _unfinished_items(self, job_id: str) -> List[dict]:
+        rows = self._connect().execute(
+            "SELECT idx, name, price, source, image_url FROM import_items WHERE job_id = ? AND status != 'done' ORDER BY idx",
+            (job_id,),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _set_job_status(self, job_id: str, status: str):
+        now = time.time()
+        if status == "running":
+            self._connect().execute("UPDATE import_jobs SET status = ?, started_at = ?, finished_at = NULL WHERE id = ?", (status, now, job_id))
+        else:
+            self._connect().execute("UPDATE import_jobs SET status = ?, finished_at = ? WHERE id = ?", (status, now, job_id))
+
+    def _update_items(self, job_id: str, updates: List[tuple]):
+        # updates: (status, image_url, product_id, error, idx); NULLs keep existing values
+        self._connect().executemany(
+            "UPDATE import_items SET status = ?, image_url = COALESCE(?, image_url), product_id = COALESCE(?, product_id), "
+            "error = ? WHERE job_id = ? AND idx = ?",
+            [(status, image_url, product_id, error, job_id, idx) for status, image_url, product_id, error, idx in updates],
+        )
+
+    async def create(self, job_id: str, shop_id: int, items: List[dict]):
+        await self._call(self._create, job_id, shop_id, items)
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        return await self._call(self._get, job_id)
+
+    async def unfinished_items(self, job_id: str) -> List[dict]:
+        return await self._call(self._unfinished_items, job_id)
+
+    async def set_job_status(self, job_id: str, status: str):
+        await self._call(self._set_job_status, job_id, status)
+
+    async def update_items(self, job_id: str, updates: List[tuple]):
+        if updates:
+            await self._call(self._update_items, job_id, updates)
+
+# --- Request parsing ---
+
+def read_manifest(data: bytes) -> Dict[str, dict]:
+    """Manifest CSV with columns filename,name,price (name/price optional per row)."""
+    manifest = {}
+    for row in csv.DictReader(io.StringIO(data.decode("utf-8-sig"))):
+        filename = (row.get("filename") or "").strip()
+        if filename:
+            manifest[os.path.basename(filename)] = row
+    return manifest
+
+def _item_from_file(filename: str, manifest: Dict[str, dict], default_price: float) -> dict:
+    row = manifest.get(os.path.basename(filename), {})
+    name = (row.get("name") or "").strip() or os.path.splitext(os.path.basename(filename))[0]
+    price = row.get("price")
+    try:
+        price = float(price) if price not in (None, "") else default_price
+    except ValueError:
+        raise BulkImportError(f"Invalid price for {filename}: {price!r}")
+    return {"name": name, "price": price}
+
+def _check_size(name: str, size: int):
+    if size > settings.BULK_IMPORT_MAX_ITEM_BYTES:
+        raise BulkImportError(f"{name} is larger than {settings.BULK_IMPORT_MAX_ITEM_BYTES} bytes")
+
+async def _download(name: str, url: str) -> bytes:
+    """
+    Streams an image URL from a CSV, refusing it as soon as it is known to be larger than
+    BULK_IMPORT_MAX_ITEM_BYTES: up front from Content-Length, otherwise once that much has arrived.
+    """
+    chunks, size = [], 0
+    async with get_http_client().stream("GET", url) as resp:
+        resp.raise_for_status()
+        length = resp.headers.get("content-length", "")
+        if length.isdigit():
+            _check_size(name, int(length))
+        # Counts decoded bytes, so a small compressed body cannot expand past the limit either
+        async for chunk in resp.aiter_bytes():
+            size += len(chunk)
+            _check_size(name, size)
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+def check_count(count: int):
+    if count > settings.BULK_IMPORT_MAX_ITEMS:
+        raise BulkImportError(f"Too many items ({count}); the limit is {settings.BULK_IMPORT_MAX_ITEMS}")
+
+def spool_file(job_dir: str, index: int, filename: str, data: bytes) -> str:
+    """Writes one image into the job directory so the job can be resumed later. Blocking."""
+    _check_size(filename, len(data))
+    os.makedirs(job_dir, exist_ok=True)
+    path = os.path.join(job_dir, f"{index}{os.path.splitext(filename)[1].lower()}")
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+def spool_archive(job_dir: str, archive, default_price: float) -> List[dict]:
+    """Extracts images (and an optional manifest.csv) from a zip archive file object, one entry at a time. Blocking."""
+    try:
+        zf = zipfile.ZipFile(archive)
+    except zipfile.BadZipFile:
+        raise BulkImportError("archive is not a valid zip file")
+    with zf:
+        manifest = {}
+        entries = []
+        for info in zf.infolist():
+            base = os.path.basename(info.filename)
+            if info.is_dir() or not base or base.startswith("."):
+                continue
+            if base.lower() == "manifest.csv":
+                manifest = read_manifest(zf.read(info))
+            elif base.lower().endswith(IMAGE_EXTENSIONS):
+                # Check the declared size before decompressing anything
+                _check_size(info.filename, info.file_size)
+                entries.append(info)
+        check_count(len(entries))
+        return [
+            {**_item_from_file(info.filename, manifest, default_price), "source": spool_file(job_dir, i, info.filename, zf.read(info))}
+            for i, info in enumerate(entries)
+        ]
+
+def item_for_file(filename: str, path: str, manifest: Dict[str, dict], default_price: float) -> dict:
+    """Item for one spooled file of a multipart batch, named and priced from the manifest (see read_manifest)."""
+    return {**_item_from_file(filename, manifest, default_price), "source": path}
+
+def parse_url_csv(data: bytes) -> List[dict]:
+    """CSV with columns name,price,image_url."""
+    items = []
+    for line, row in enumerate(csv.DictReader(io.StringIO(data.decode("utf-8-sig"))), start=2):
+        name, price, url = (row.get("name") or "").strip(), (row.get("price") or "").strip(), (row.get("image_url") or "").strip()
+        if not name or not url:
+            raise BulkImportError(f"CSV line {line}: name and image_url are required")
+        try:
+            items.append({"name": name, "price": float(price or 0), "source": url})
+        except ValueError:
+            raise BulkImportError(f"CSV line {line}: invalid price {price!r}")
+    check_count(len(items))
+    return items
+
+# --- Pipeline ---
+
+_END = object()
+
+class _Item:
+    __slots__ = ("idx", "name", "price", "source", "raw", "prepared", "image_url", "description", "image_hash", "embedding")
+
+    def __init__(self, idx: int, name: str, price: float, source: str, image_url: Optional[str]):
+        self.idx = idx
+        self.name = name
+        self.price = price
+        self.source = source
+        self.image_url = image_url
+        self.raw = None
+        self.prepared = None
+        self.description = None
+        self.image_hash = None
+        self.embedding = None
+
+class ImportPipeline:
+    """
+    Runs one import job as a chain of bounded stages connected by bounded queues:
+    decode -> storage upload -> describe -> embed (batched) -> insert (batched).
+    Each stage has its own worker count, so a slow stage applies backpressure upstream instead of
+    letting items pile up in memory. Item outcomes are checkpointed in the job store as they happen.
+    """
+
+    def __init__(self, store: ImportJobStore, job_id: str, shop_id: int):
+        self.store = store
+        self.job_id = job_id
+        self.shop_id = shop_id
+        self.started = time.monotonic()
+        self.stage_counts = {"decoded": 0, "uploaded": 0, "described": 0, "embedded": 0, "inserted": 0, "failed": 0}
+
+    async def _fail(self, items: List[_Item], stage: str, error: Exception):
+        self.stage_counts["failed"] += len(items)
+        logger.error("Import %s: %s failed for %s item(s): %s", self.job_id, stage, len(items), error)
+        await self.store.update_items(self.job_id, [("failed", None, None, f"{stage}: {error}", item.idx) for item in items])
+
+    # Stage functions
+
+    async def _decode(self, item: _Item) -> _Item:
+        if item.source.startswith(("http://", "https://")):
+            item.raw = await _download(item.name, item.source)
+        else:
+            item.raw = await run_image_task(_read_file, item.source)
+            _check_size(item.name, len(item.raw))
+        # Also validates that the bytes are a decodable image
+        item.prepared = await run_image_task(prepare_image, item.raw)
+        self.stage_counts["decoded"] += 1
+        return item
+
+    async def _upload(self, item: _Item) -> _Item:
+        if item.image_url is None:  # Already uploaded in an earlier run of this job
+            item.image_url = await repository.upload_product_image(f"{self.shop_id}/{uuid.uuid4()}.jpg", item.raw, "image/jpeg")
+            await self.store.update_items(self.job_id, [("pending", item.image_url, None, None, item.idx)])
+        # Only the prepared copy travels further; the original can be up to BULK_IMPORT_MAX_ITEM_BYTES.
+        # The product image cache fills itself on the first verification that needs the image.
+        item.raw = None
+        self.stage_counts["uploaded"] += 1
+        return item
+
+    async def _describe(self, item: _Item) -> _Item:
+        result = await describe_prepared_async(item.prepared)
+        item.prepared = None
+        item.description, item.image_hash, item.embedding = result["description"], result["image_hash"], result["embedding"]
+        self.stage_counts["described"] += 1
+        return item
+
+    async def _embed(self, batch: List[_Item]) -> List[_Item]:
+        pending = [item for item in batch if item.embedding is None]
+        if pending:
+            vectors = await embed_descriptions_async([item.description for item in pending])
+            for item, embedding in zip(pending, vectors):
+                item.embedding = embedding
+                await remember_result_async(item.image_hash, item.description, embedding)
+        self.stage_counts["embedded"] += len(batch)
+        return batch
+
+    async def _insert(self, batch: List[_Item]) -> List[_Item]:
+        rows = await repository.insert_products([
+            {
+                "shop_id": self.shop_id,
+                "name": item.name,
+                "price": item.price,
+                "image_url": item.image_url,
+                "embedding": item.embedding,
+                "description": item.description,
+            }
+            for item in batch
+        ])
+        await self.store.update_items(
+            self.job_id, [("done", None, str(row.get("id")), None, item.idx) for item, row in zip(batch, rows)]
+        )
+        for row in rows:
+            vector_index.add_product(row)
+        self.stage_counts["inserted"] += len(batch)
+        return batch
+
+    # Stage runners
+
+    async def _stage(self, name: str, inbox: asyncio.Queue, outbox: Optional[asyncio.Queue], fn, workers: int):
+        async def _worker():
+            while True:
+                item = await inbox.get()
+                if item is _END:
+                    await inbox.put(_END)  # Let sibling workers see it too
+                    return
+                try:
+                    result = await fn(item)
+                except Exception as e:
+                    await self._fail([item], name, e)
+                    continue
+                if outbox is not None:
+                    await outbox.put(result)
+
+        await asyncio.gather(*[_worker() for _ in range(workers)])
+        if outbox is not None:
+            await outbox.put(_END)
+
+    async def _batch_stage(self, name: str, inbox: asyncio.Queue, outbox: Optional[asyncio.Queue], fn, batch_size: int):
+        linger = settings.BULK_IMPORT_BATCH_LINGER
+        loop = asyncio.get_running_loop()
+        finished = False
+        while not finished:
+            item = await inbox.get()
+            if item is _END:
+                break
+            batch = [item]
+            deadline = loop.time() + linger
+            while len(batch) < batch_size:
+                try:
+                    item = await asyncio.wait_for(inbox.get(), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+                if item is _END:
+                    finished = True
+                    break
+                batch.append(item)
+            try:
+                results = await fn(batch)
+            except Exception as e:
+                await self._fail(batch, name, e)
+                continue
+            if outbox is not None:
+                for result in results:
+                    await outbox.put(result)
+        if outbox is not None:
+            await outbox.put(_END)
+
+    async def run(self, items: List[dict]):
+        size = settings.BULK_IMPORT_QUEUE_SIZE
+        to_decode, to_upload, to_describe, to_embed, to_insert = (asyncio.Queue(size) for _ in range(5))
+
+        async def _feed():
+            for row in items:
+                await to_decode.put(_Item(row["idx"], row["name"], row["price"], row["source"], row.get("image_url")))
+            await to_decode.put(_END)
+
+        await asyncio.gather(
+            _feed(),
+            self._stage("decode", to_decode, to_upload, self._decode, settings.BULK_IMPORT_DECODE_WORKERS),
+            self._stage("upload", to_upload, to_describe, self._upload, settings.BULK_IMPORT_UPLOAD_WORKERS),
+            self._stage("describe", to_describe, to_embed, self._describe, settings.BULK_IMPORT_DESCRIBE_WORKERS),
+            self._batch_stage("embed", to_embed, to_insert, self._embed, settings.EMBED_BATCH_SIZE),
+            self._batch_stage("insert", to_insert, None, self._insert, settings.BULK_IMPORT_INSERT_BATCH_SIZE),
+        )
+
+    def progress(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            **self.stage_counts,
+            "elapsed_seconds": round(elapsed, 1),
+            "items_per_second": round(self.stage_counts["inserted"] / elapsed, 2) if elapsed else 0.0,
+        }
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+# --- Job manager ---
+
+class BulkImporter:
+    """Creates, runs, reports on and resumes import jobs. Running jobs are tracked per worker."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.store = ImportJobStore(directory)
+        self._running: Dict[str, ImportPipeline] = {}
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.directory, job_id)
+
+    async def discard_files(self, job_id: str):
+        """Deletes a job's spooled images (once it has nothing left to resume, or was never created)."""
+        await run_image_task(shutil.rmtree, self.job_dir(job_id), True)
+
+    async def create_job(self, shop_id: int, items: List[dict], job_id: Optional[str] = None) -> str:
+        if not items:
+            raise BulkImportError("No images found in the request")
+        job_id = job_id or uuid.uuid4().hex
+        await self.store.create(job_id, shop_id, items)
+        return job_id
+
+    def is_running(self, job_id: str) -> bool:
+        return job_id in self._running
+
+    async def run_job(self, job_id: str):
+        """Processes every item of the job that is not done yet (so it also resumes)."""
+        job = await self.store.get(job_id)
+        if job is None or job_id in self._running:
+            return
+        pipeline = ImportPipeline(self.store, job_id, job["shop_id"])
+        self._running[job_id] = pipeline
+        await self.store.set_job_status(job_id, "running")
+        try:
+            await pipeline.run(await self.store.unfinished_items(job_id))
+            job = await self.store.get(job_id)
+            status = "completed" if job["items"]["failed"] == 0 else "completed_with_errors"
+        except Exception as e:
+            logger.error("Import %s aborted: %r", job_id, e)
+            status = "failed"
+        finally:
+            self._running.pop(job_id, None)
+        await self.store.set_job_status(job_id, status)
+        logger.info("Import %s finished: %s, %s", job_id, status, pipeline.progress())
+        if status == "completed":
+            await self.discard_files(job_id)
+
+    async def get_job(self, job_id: str) -> Optional[dict]:
+        job = await self.store.get(job_id)
+        if job is not None and job_id in self._running:
+            job["progress"] = self._running[job_id].progress()
+        return job
+
+bulk_importer = BulkImporter(settings.BULK_IMPORT_DIR)
@@ -0,0 +1,80 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+from app.config import get_settings
+
+settings = get_settings()
+
+class CallLimiter:
+    """
+    Caps how many calls of one kind run at once (async context manager), with counters.
+    Each kind of AI call gets its own limiter, so a slow model only queues its own callers.
+    """
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+        self.in_flight = 0
+        self.waiting = 0
+        self.completed = 0
+        self._semaphore = asyncio.Semaphore(size)
+
+    async def __aenter__(self):
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.in_flight -= 1
+        self.completed += 1
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {"size": self.size, "in_flight": self.in_flight, "waiting": self.waiting, "completed": self.completed}
+
+class RateLimiter:
+    """Spaces calls evenly to stay under a requests-per-minute quota (0 disables it)."""
+
+    def __init__(self, name: str, per_minute: int):
+        self.name = name
+        self.per_minute = per_minute
+        self._interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self._interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self._interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+describe_limiter = CallLimiter("describe", settings.AI_DESCRIBE_CONCURRENCY)
+embed_limiter = CallLimiter("embed", settings.AI_EMBED_CONCURRENCY)
+verify_limiter = CallLimiter("verify", settings.AI_VERIFY_CONCURRENCY)
+chat_limiter = CallLimiter("chat", settings.AI_CHAT_CONCURRENCY)
+embed_rate_limiter = RateLimiter("embed_batch", settings.EMBED_REQUESTS_PER_MINUTE)
+
+# CPU-bound image work (PIL decode/encode) runs here instead of on asyncio's shared default pool
+image_executor = ThreadPoolExecutor(max_workers=settings.IMAGE_EXECUTOR_WORKERS, thread_name_prefix="image")
+
+async def run_image_task(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(image_executor, fn, *args)
+
+def concurrency_stats() -> Dict[str, dict]:
+    stats = {limiter.name: limiter.stats() for limiter in (describe_limiter, embed_limiter, verify_limiter, chat_limiter)}
+    stats["image_executor"] = {"size": settings.IMAGE_EXECUTOR_WORKERS}
+    return stats
+
+def shutdown():
+    image_executor.shutdown(wait=False)
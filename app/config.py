@@ -13,12 +13,131 @@ class Settings(BaseSettings):
 
     # Security
     ENCRYPTION_KEY: str # Must be a valid Fernet key (32 url-safe base64-encoded bytes)
+    TOKEN_CACHE_ENABLED: bool = True # Keep decrypted page tokens in memory
+    TOKEN_CACHE_TTL: float = 900.0
+    TOKEN_CACHE_MAX_SIZE: int = 1000
 
     # App
     ENV: str = "development"
+    LOG_LEVEL: str = "INFO" # Level of the OmniVision logger; other libraries log WARNING and above
+    LOG_FORMAT: str = "json" # json (one object per line) | text
     
     # Google Gemini
     GEMINI_API_KEY: str
+    GEMINI_MODEL: str = "gemini-2.0-flash"
+    GEMINI_EMBEDDING_MODEL: str = "models/text-embedding-004" # 768 dimensions
+    # Per-role generation settings. An empty safety threshold keeps the API default;
+    # otherwise one of BLOCK_NONE, BLOCK_ONLY_HIGH, BLOCK_MEDIUM_AND_ABOVE, BLOCK_LOW_AND_ABOVE.
+    DESCRIBE_MAX_OUTPUT_TOKENS: int = 300
+    DESCRIBE_TEMPERATURE: float = 0.2
+    DESCRIBE_SAFETY_THRESHOLD: str = ""
+    VERIFY_MAX_OUTPUT_TOKENS: int = 16
+    VERIFY_TEMPERATURE: float = 0.0
+    VERIFY_SAFETY_THRESHOLD: str = ""
+    CHAT_MAX_OUTPUT_TOKENS: int = 512
+    CHAT_TEMPERATURE: float = 0.7
+    CHAT_SAFETY_THRESHOLD: str = ""
+    # Max concurrent Gemini calls per kind, per worker
+    AI_DESCRIBE_CONCURRENCY: int = 16
+    AI_EMBED_CONCURRENCY: int = 32
+    AI_VERIFY_CONCURRENCY: int = 8
+    AI_CHAT_CONCURRENCY: int = 16
+    IMAGE_EXECUTOR_WORKERS: int = 4 # Threads for PIL decoding/encoding
+    EMBED_BATCH_SIZE: int = 100 # Texts per batch embedding request (API maximum is 100)
+    EMBED_REQUESTS_PER_MINUTE: int = 0 # Quota for batch embedding requests; 0 = unlimited
+    # Images are downscaled and re-encoded before upload to Gemini
+    IMAGE_MAX_EDGE: int = 1024 # Longest edge in pixels
+    IMAGE_FORMAT: str = "JPEG" # JPEG or WEBP
+    IMAGE_QUALITY: int = 85
+
+    # process_image result cache (description + embedding), keyed by normalized image hash
+    RESULT_CACHE_MAX_SIZE: int = 2000 # Memory tier entries
+    RESULT_CACHE_TTL: float = 604800.0 # 7 days
+    RESULT_CACHE_DIR: str = "" # Disk tier directory; empty disables it
+    RESULT_CACHE_DISK_MAX_BYTES: int = 268435456 # 256 MB
+
+    # Visual verification scores keyed by (query image hash, product, product image)
+    VERIFY_CACHE_MAX_SIZE: int = 10000
+    VERIFY_CACHE_TTL: float = 86400.0
+
+    # Verification mode: "visual" always compares the two images with Gemini; "text_first" compares the
+    # query description with the stored product description and only sends ambiguous cases to visual.
+    VERIFY_MODE: str = "visual"
+    TEXT_VERIFY_METHOD: str = "local" # local (string/attribute similarity, free) | gemini (text-only call)
+    TEXT_VERIFY_ACCEPT: int = 80 # Text score at or above this is accepted without the image call
+    TEXT_VERIFY_REJECT: int = 30 # Text score at or below this is rejected without the image call
+    VERIFY_TOP_N: int = 1 # Matches verified per search; the best-scoring one is sent
+    VERIFY_TOP_N_CONCURRENCY: int = 3 # Candidates downloaded/verified at once per search
+
+    # Catalog product images used for verification
+    PRODUCT_IMAGE_CACHE_MEMORY_BYTES: int = 67108864 # 64 MB
+    PRODUCT_IMAGE_CACHE_DIR: str = "data/product_images" # Empty disables the disk tier
+    PRODUCT_IMAGE_CACHE_DISK_BYTES: int = 1073741824 # 1 GB
+    PRODUCT_IMAGE_CACHE_REVALIDATE_AFTER: float = 3600.0 # Seconds before a conditional GET
+    PRODUCT_IMAGE_CACHE_WARM_LIMIT: int = 200 # Newest products fetched when a shop is warmed
+
+    # Bulk product import (POST /shops/{page_id}/products/bulk)
+    BULK_IMPORT_DIR: str = "data/imports" # Job database and spooled images, kept for resuming
+    BULK_IMPORT_MAX_ITEMS: int = 5000
+    BULK_IMPORT_MAX_ITEM_BYTES: int = 20971520 # 20 MB per image
+    BULK_IMPORT_QUEUE_SIZE: int = 32 # Items buffered between two pipeline stages
+    BULK_IMPORT_DECODE_WORKERS: int = 4
+    BULK_IMPORT_UPLOAD_WORKERS: int = 8
+    BULK_IMPORT_DESCRIBE_WORKERS: int = 8
+    BULK_IMPORT_INSERT_BATCH_SIZE: int = 50
+    BULK_IMPORT_BATCH_LINGER: float = 1.0 # Seconds a batching stage waits to fill a batch
+
+    # Outbound HTTP (shared pooled client for Graph API and image downloads)
+    HTTP_MAX_CONNECTIONS: int = 100
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    HTTP_KEEPALIVE_EXPIRY: float = 30.0 # Seconds an idle connection is kept open
+    HTTP_TIMEOUT: float = 15.0 # Read/write timeout in seconds
+    HTTP_CONNECT_TIMEOUT: float = 5.0
+    HTTP_POOL_TIMEOUT: float = 5.0 # Max wait for a free connection from the pool
+    HTTP2_ENABLED: bool = True
+
+    # Database (sync Supabase client offloaded to a bounded thread pool)
+    DB_MAX_WORKERS: int = 16
+
+    # Shop config cache (per worker; PUT/POST/DELETE on a shop invalidate it locally,
+    # the TTL bounds how long other workers can serve a stale row)
+    SHOP_CACHE_TTL: float = 60.0
+    SHOP_CACHE_MAX_SIZE: int = 5000
+
+    # Write-behind credit ledger (optional). Each worker reserves a block of credits per owner,
+    # spends it locally and returns the unused part when the owner goes idle or on shutdown.
+    CREDIT_LEDGER_ENABLED: bool = False
+    CREDIT_LEDGER_BLOCK_SIZE: int = 20 # Credits reserved per round-trip
+    CREDIT_LEDGER_WORKERS: int = 4 # Worker processes sharing a balance (gunicorn --workers); blocks need BLOCK_SIZE x this
+    CREDIT_LEDGER_REFILL_AT: int = 5 # Refill in the background when this many are left
+    CREDIT_LEDGER_IDLE_SECONDS: float = 120.0 # Release an owner's allowance after this long unused
+    CREDIT_LEDGER_FLUSH_INTERVAL: float = 30.0
+
+    # Durable webhook event queue (SQLite file shared by all workers on the host)
+    EVENT_QUEUE_ENABLED: bool = True
+    EVENT_QUEUE_PATH: str = "data/webhook_events.sqlite3"
+    EVENT_QUEUE_WORKERS: int = 8 # Async consumers per worker process
+    EVENT_QUEUE_VISIBILITY_TIMEOUT: float = 180.0 # Seconds before an unacknowledged event is redelivered
+    EVENT_QUEUE_MAX_ATTEMPTS: int = 3
+    EVENT_QUEUE_MAX_DEPTH: int = 10000 # Webhook answers 503 above this, so Facebook retries later
+    EVENT_QUEUE_POLL_INTERVAL: float = 0.5
+    EVENT_QUEUE_SHUTDOWN_GRACE: float = 20.0 # Seconds running events get to finish on shutdown; keep below gunicorn's --graceful-timeout (30)
+
+    # Webhook deduplication by message.mid
+    DEDUP_BACKEND: str = "memory" # memory (per worker) | sqlite (per host) | redis (shared)
+    DEDUP_TTL: float = 21600.0 # Seconds a message id is remembered
+    DEDUP_MAX_SIZE: int = 100000 # Memory backend only
+    DEDUP_SQLITE_PATH: str = "data/dedup.sqlite3"
+    REDIS_URL: str = "redis://localhost:6379/0"
+
+    # In-process per-shop vector index (serves match_products without a database round-trip)
+    VECTOR_INDEX_ENABLED: bool = True
+    VECTOR_INDEX_MAX_SHOPS: int = 50 # Shops kept in memory per worker (LRU)
+    VECTOR_INDEX_TTL: float = 300.0 # Seconds before a shop's index is reloaded (picks up other workers' inserts)
+    VECTOR_INDEX_HNSW_MIN_ROWS: int = 20000 # Catalogs this large use HNSW (approximate) if hnswlib is installed
+    VECTOR_INDEX_HNSW_EF: int = 128 # HNSW search breadth; higher is more accurate and slower
+    VECTOR_INDEX_PRECISION: str = "int8" # Screening copy: int8 | float16 | float32 (results stay exact)
+    VECTOR_INDEX_RERANK_DIR: str = "data/vector_index" # Memory-map the exact float32 rows here ("" keeps them in RAM)
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from app import repository
+from app.config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger("OmniVision")
+
+class _Allowance:
+    __slots__ = ("remaining", "last_used", "refill", "blocks_paused_until")
+
+    def __init__(self):
+        self.remaining = 0
+        self.last_used = time.monotonic()
+        self.refill: Optional[asyncio.Task] = None
+        self.blocks_paused_until = 0.0 # Set when the balance was too low for a block
+
+class CreditLedger:
+    """
+    Per-worker write-behind credit ledger.
+
+    Credits are reserved from the database in blocks (the database balance drops immediately,
+    so an owner can never be overspent by more than what the workers hold), spent locally,
+    topped up in the background before they run out, and whatever is left is handed back
+    in one batched call once the owner has been idle for a while or the worker shuts down.
+
+    A block is only granted while the balance covers one for every worker, so one worker cannot
+    sit on credits another worker needs. Below that, credits are taken one at a time with
+    reserve_credit, and block requests for the owner pause for a flush interval.
+    """
+
+    def __init__(self, block_size: int, refill_at: int, idle_seconds: float, flush_interval: float,
+                 workers: int = 1):
+        self.block_size = block_size
+        self.workers = workers
+        self.refill_at = refill_at
+        self.idle_seconds = idle_seconds
+        self.flush_interval = flush_interval
+        self.consumed = 0
+        self.db_reserves = 0
+        self.db_releases = 0
+        self._allowances: Dict[str, _Allowance] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def consume(self, owner_id: str) -> bool:
+        """Spends one credit for owner_id. Returns False if the owner is out of credits."""
+        allowance = self._allowances.get(owner_id)
+        if allowance is None:
+            allowance = self._allowances[owner_id] = _Allowance()
+
+        while allowance.remaining <= 0:
+            granted = 0
+            if time.monotonic() >= allowance.blocks_paused_until:
+                # Nothing left locally: wait for a (possibly already running) refill.
+                # Concurrent consumers may drain it first, so retry until no block is granted.
+                granted = await asyncio.shield(self._start_refill(owner_id, allowance))
+            if granted <= 0 and allowance.remaining <= 0:
+                # No block to spare: take a single credit atomically, straight from the database
+                allowance.last_used = time.monotonic()
+                if await repository.reserve_credit(owner_id) is None:
+                    return False
+                self.db_reserves += 1
+                self.consumed += 1
+                return True
+
+        allowance.remaining -= 1
+        self.consumed += 1
+        allowance.last_used = time.monotonic()
+
+        if (allowance.remaining <= self.refill_at and allowance.refill is None
+                and time.monotonic() >= allowance.blocks_paused_until):
+            self._start_refill(owner_id, allowance).add_done_callback(self._log_refill_error)
+        return True
+
+    def refund(self, owner_id: str, amount: int = 1):
+        """Gives back credits that were consumed for work that never happened."""
+        allowance = self._allowances.get(owner_id)
+        if allowance is None:
+            allowance = self._allowances[owner_id] = _Allowance()
+        allowance.remaining += amount
+        self.consumed -= amount
+
+    def _start_refill(self, owner_id: str, allowance: _Allowance) -> asyncio.Task:
+        if allowance.refill is None:
+            allowance.refill = asyncio.create_task(self._refill(owner_id, allowance))
+        return allowance.refill
+
+    async def _refill(self, owner_id: str, allowance: _Allowance) -> int:
+        try:
+            granted = await repository.reserve_credits_block(owner_id, self.block_size, self.workers)
+            self.db_reserves += 1
+            allowance.remaining += granted
+            if granted:
+                logger.info("Reserved %s credits for user %s", granted, owner_id)
+            else:
+                allowance.blocks_paused_until = time.monotonic() + self.flush_interval
+            return granted
+        finally:
+            allowance.refill = None
+
+    @staticmethod
+    def _log_refill_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Background credit refill failed: %s", task.exception())
+
+    async def flush(self, idle_only: bool = True):
+        """Returns unused allowances to the database in a single batched call."""
+        now = time.monotonic()
+        deltas: Dict[str, int] = {}
+        for owner_id, allowance in list(self._allowances.items()):
+            if allowance.refill is not None:
+                continue
+            if idle_only and now - allowance.last_used < self.idle_seconds:
+                continue
+            del self._allowances[owner_id]
+            if allowance.remaining > 0:
+                deltas[owner_id] = allowance.remaining
+        if not deltas:
+            return
+        try:
+            await repository.release_credits(deltas)
+            self.db_releases += 1
+            logger.info("Released unused credits for %s users", len(deltas))
+        except Exception as e:
+            logger.error("Failed to release credits, keeping them for the next flush: %s", e)
+            for owner_id, amount in deltas.items():
+                allowance = self._allowances.setdefault(owner_id, _Allowance())
+                allowance.remaining += amount
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush(idle_only=True)
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Stops the periodic flush and returns every unused allowance."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        pending = [a.refill for a in self._allowances.values() if a.refill is not None]
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        await self.flush(idle_only=False)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": settings.CREDIT_LEDGER_ENABLED,
+            "owners": len(self._allowances),
+            "held": sum(a.remaining for a in self._allowances.values()),
+            "consumed": self.consumed,
+            "db_reserves": self.db_reserves,
+            "db_releases": self.db_releases,
+        }
+
+credit_ledger = CreditLedger(
+    block_size=settings.CREDIT_LEDGER_BLOCK_SIZE,
+    refill_at=settings.CREDIT_LEDGER_REFILL_AT,
+    idle_seconds=settings.CREDIT_LEDGER_IDLE_SECONDS,
+    flush_interval=settings.CREDIT_LEDGER_FLUSH_INTERVAL,
+    workers=settings.CREDIT_LEDGER_WORKERS,
+)
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from app.cache import TTLCache
+from app.config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger("OmniVision")
+
+class DedupBackend(ABC):
+    """Seen-set of message ids. `mark` returns True the first time a key is seen within the TTL."""
+
+    @abstractmethod
+    async def mark(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def forget(self, key: str):
+        ...
+
+    async def close(self):
+        pass
+
+class MemoryDedup(DedupBackend):
+    """Per-worker seen-set. Cheap, but redeliveries that land on another worker are not caught."""
+
+    def __init__(self, ttl: float, max_size: int):
+        self._seen = TTLCache(maxsize=max_size, ttl=ttl)
+
+    async def mark(self, key: str) -> bool:
+        if self._seen.get(key) is not None:
+            return False
+        self._seen.set(key, True)
+        return True
+
+    async def forget(self, key: str):
+        self._seen.pop(key)
+
+class SQLiteDedup(DedupBackend):
+    """Seen-set in a local SQLite file, shared by all workers on the host."""
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dedup")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._last_purge = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS seen_messages (mid TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+            self._conn = conn
+        return self._conn
+
+    def _mark(self, key: str) -> bool:
+        conn = self._connect()
+        now = time.time()
+        if now - self._last_purge > self.ttl / 10:
+            conn.execute("DELETE FROM seen_messages WHERE expires_at <= ?", (now,))
+            self._last_purge = now
+        # Inserts a new key, or revives an expired one; either way exactly one row changes
+        cursor = conn.execute(
+            "INSERT INTO seen_messages (mid, expires_at) VALUES (?, ?) "
+            "ON CONFLICT(mid) DO UPDATE SET expires_at = excluded.expires_at WHERE seen_messages.expires_at <= ?",
+            (key, now + self.ttl, now),
+        )
+        return cursor.rowcount == 1
+
+    def _forget(self, key: str):
+        self._connect().execute("DELETE FROM seen_messages WHERE mid = ?", (key,))
+
+    async def mark(self, key: str) -> bool:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io, self._mark, key)
+
+    async def forget(self, key: str):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._io, self._forget, key)
+
+    async def close(self):
+        if self._conn is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._io, self._conn.close)
+            self._conn = None
+        self._io.shutdown(wait=False)
+
+class RedisDedup(DedupBackend):
+    """Seen-set in Redis (or any Redis-compatible store), shared across hosts."""
+
+    def __init__(self, url: str, ttl: float, prefix: str = "omnivision:mid:"):
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError:
+            raise RuntimeError("DEDUP_BACKEND=redis requires the 'redis' package (pip install redis)")
+        self._redis = redis_asyncio.from_url(url)
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    async def mark(self, key: str) -> bool:
+        return bool(await self._redis.set(self.prefix + key, 1, nx=True, ex=self.ttl))
+
+    async def forget(self, key: str):
+        await self._redis.delete(self.prefix + key)
+
+    async def close(self):
+        await self._redis.close()
+
+class EventDeduplicator:
+    """Drops webhook events whose message.mid was already accepted (Facebook redeliveries)."""
+
+    def __init__(self, backend: DedupBackend):
+        self.backend = backend
+        self.dropped = 0
+
+    @staticmethod
+    def event_key(event: dict) -> Optional[str]:
+        return (event.get("message") or {}).get("mid")
+
+    async def is_duplicate(self, event: dict) -> bool:
+        key = self.event_key(event)
+        if not key:
+            return False
+        if await self.backend.mark(key):
+            return False
+        self.dropped += 1
+        return True
+
+    async def forget(self, event: dict):
+        """Un-marks an event we accepted but failed to hand off, so its redelivery is processed."""
+        key = self.event_key(event)
+        if key:
+            await self.backend.forget(key)
+
+    def stats(self) -> dict:
+        return {"backend": settings.DEDUP_BACKEND, "dropped": self.dropped}
+
+def build_deduplicator() -> EventDeduplicator:
+    backend_name = settings.DEDUP_BACKEND.lower()
+    if backend_name == "memory":
+        backend = MemoryDedup(ttl=settings.DEDUP_TTL, max_size=settings.DEDUP_MAX_SIZE)
+    elif backend_name == "sqlite":
+        backend = SQLiteDedup(path=settings.DEDUP_SQLITE_PATH, ttl=settings.DEDUP_TTL)
+    elif backend_name == "redis":
+        backend = RedisDedup(url=settings.REDIS_URL, ttl=settings.DEDUP_TTL)
+    else:
+        raise ValueError(f"Unknown DEDUP_BACKEND: {settings.DEDUP_BACKEND}")
+    return EventDeduplicator(backend)
+
+deduplicator = build_deduplicator()
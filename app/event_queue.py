@@ -0,0 +1,274 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from app.config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger("OmniVision")
+
+class QueueFull(Exception):
+    """Raised when the queue is at EVENT_QUEUE_MAX_DEPTH and cannot accept more events."""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    visible_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    dead INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_webhook_events_ready ON webhook_events (dead, visible_at);
+CREATE TABLE IF NOT EXISTS event_charges (
+    message_id TEXT PRIMARY KEY,
+    owner_id TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_event_charges_created ON event_charges (created_at);
+"""
+
+# How long a charge is remembered; far longer than an event can keep being retried
+CHARGE_RETENTION = 86400.0
+
+class EventQueue:
+    """
+    Durable webhook event queue on a local SQLite file (WAL mode).
+
+    All gunicorn workers on the host share the file. A claimed event stays invisible to other
+    consumers for `visibility_timeout` seconds; if it is not acknowledged by then (worker crashed
+    or recycled) it becomes visible again. Events that fail `max_attempts` times are kept as dead.
+
+    Handlers are not idempotent, so the file also records which owner a message was charged to:
+    a redelivered event reuses that charge instead of paying again.
+    """
+
+    def __init__(self, path: str, visibility_timeout: float, max_attempts: int, max_depth: int):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.max_depth = max_depth
+        # sqlite3 is blocking; one dedicated thread owns the connection
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="event-queue")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._ready = asyncio.Event()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    async def _call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io, fn, *args)
+
+    # --- Blocking operations (run on the queue thread) ---
+
+    def _append(self, payloads: List[str]):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            (depth,) = conn.execute("SELECT COUNT(*) FROM webhook_events WHERE dead = 0").fetchone()
+            if depth + len(payloads) > self.max_depth:
+                raise QueueFull(f"Event queue is full ({depth} pending)")
+            conn.executemany(
+                "INSERT INTO webhook_events (payload, visible_at, created_at) VALUES (?, ?, ?)",
+                [(payload, now, now) for payload in payloads],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _claim(self) -> Optional[Tuple[int, str, int]]:
+        conn = self._connect()
+        now = time.time()
+        # Events whose consumer died too many times are parked instead of looping forever
+        conn.execute(
+            "UPDATE webhook_events SET dead = 1, last_error = COALESCE(last_error, 'visibility timeout') "
+            "WHERE dead = 0 AND attempts >= ? AND visible_at <= ?",
+            (self.max_attempts, now),
+        )
+        return conn.execute(
+            "UPDATE webhook_events SET attempts = attempts + 1, visible_at = ? "
+            "WHERE id = (SELECT id FROM webhook_events WHERE dead = 0 AND visible_at <= ? ORDER BY id LIMIT 1) "
+            "RETURNING id, payload, attempts",
+            (now + self.visibility_timeout, now),
+        ).fetchone()
+
+    def _ack(self, event_id: int):
+        self._connect().execute("DELETE FROM webhook_events WHERE id = ?", (event_id,))
+
+    def _nack(self, event_id: int, error: str, delay: float):
+        self._connect().execute(
+            "UPDATE webhook_events SET visible_at = ?, last_error = ?, dead = (attempts >= ?) WHERE id = ?",
+            (time.time() + delay, error, self.max_attempts, event_id),
+        )
+
+    def _record_charge(self, message_id: str, owner_id: str):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("DELETE FROM event_charges WHERE created_at <= ?", (now - CHARGE_RETENTION,))
+        conn.execute(
+            "INSERT OR REPLACE INTO event_charges (message_id, owner_id, created_at) VALUES (?, ?, ?)",
+            (message_id, owner_id, now),
+        )
+
+    def _get_charge(self, message_id: str) -> Optional[str]:
+        row = self._connect().execute("SELECT owner_id FROM event_charges WHERE message_id = ?", (message_id,)).fetchone()
+        return row[0] if row else None
+
+    def _clear_charge(self, message_id: str):
+        self._connect().execute("DELETE FROM event_charges WHERE message_id = ?", (message_id,))
+
+    def _stats(self) -> dict:
+        conn = self._connect()
+        pending, dead = conn.execute(
+            "SELECT COALESCE(SUM(dead = 0), 0), COALESCE(SUM(dead = 1), 0) FROM webhook_events"
+        ).fetchone()
+        return {"pending": pending, "dead": dead}
+
+    # --- Async API ---
+
+    async def append(self, events: List[dict]):
+        """Persists events. Raises QueueFull when the backlog is at max_depth."""
+        if not events:
+            return
+        await self._call(self._append, [json.dumps(event) for event in events])
+        self._ready.set()
+
+    async def claim(self) -> Optional[Tuple[int, dict, int]]:
+        """Claims the oldest visible event as (id, event, attempt), or None if there is none."""
+        row = await self._call(self._claim)
+        if row is None:
+            return None
+        event_id, payload, attempts = row
+        return event_id, json.loads(payload), attempts
+
+    async def ack(self, event_id: int):
+        await self._call(self._ack, event_id)
+
+    async def nack(self, event_id: int, error: str, delay: float = 0.0):
+        """Makes a failed event visible again after `delay`, or parks it once out of attempts."""
+        await self._call(self._nack, event_id, error, delay)
+
+    async def wait_for_events(self, timeout: float):
+        """Sleeps until this process appends something or `timeout` passes (other workers may append too)."""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._ready.clear()
+
+    async def record_charge(self, message_id: str, owner_id: str):
+        """Remembers that processing this message charged `owner_id`."""
+        await self._call(self._record_charge, message_id, owner_id)
+
+    async def get_charge(self, message_id: str) -> Optional[str]:
+        """The owner an earlier attempt of this message charged, or None."""
+        return await self._call(self._get_charge, message_id)
+
+    async def clear_charge(self, message_id: str):
+        """Forgets a charge that was refunded, so a redelivery pays again."""
+        await self._call(self._clear_charge, message_id)
+
+    async def stats(self) -> dict:
+        return await self._call(self._stats)
+
+    def close(self):
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        self._io.submit(_close)
+        self._io.shutdown(wait=True)
+
+class EventWorkerPool:
+    """A fixed number of async consumers that drain the EventQueue through `handler`."""
+
+    def __init__(self, queue: EventQueue, handler: Callable[[dict], Awaitable[None]], size: int, poll_interval: float):
+        self.queue = queue
+        self.handler = handler
+        self.size = size
+        self.poll_interval = poll_interval
+        self.processed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+
+    def start(self):
+        self._stopping = False
+        for i in range(self.size):
+            self._tasks.append(asyncio.create_task(self._consume(), name=f"event-worker-{i}"))
+
+    async def stop(self, grace: float = 0.0):
+        """
+        Stops claiming events and gives handlers that are still running up to `grace` seconds to
+        finish. Whatever is left after that is cancelled and its event handed back to the queue.
+        """
+        self._stopping = True
+        if self._tasks:
+            # Idle consumers exit within poll_interval; busy ones when their handler returns
+            _, pending = await asyncio.wait(self._tasks, timeout=grace)
+            if pending:
+                logger.warning("Cancelling %s event handlers still running after %ss", self.in_flight, grace)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _consume(self):
+        while not self._stopping:
+            try:
+                claimed = await self.queue.claim()
+            except Exception as e:
+                logger.error("Event queue claim failed: %s", e)
+                await asyncio.sleep(self.poll_interval)
+                continue
+            if claimed is None:
+                await self.queue.wait_for_events(self.poll_interval)
+                continue
+
+            event_id, event, attempt = claimed
+            self.in_flight += 1
+            try:
+                # Finish before the claim expires so no other consumer picks the event up meanwhile
+                await asyncio.wait_for(self.handler(event), timeout=self.queue.visibility_timeout)
+            except asyncio.CancelledError:
+                # Shutting down: hand the event straight back instead of waiting for the timeout
+                await asyncio.shield(self.queue.nack(event_id, "worker shutdown"))
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.error("Event %s failed (attempt %s): %r", event_id, attempt, e)
+                await self.queue.nack(event_id, repr(e), delay=min(2 ** attempt, 60))
+            else:
+                self.processed += 1
+                await self.queue.ack(event_id)
+            finally:
+                self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {"workers": self.size, "in_flight": self.in_flight, "processed": self.processed, "failed": self.failed}
+
+event_queue = EventQueue(
+    path=settings.EVENT_QUEUE_PATH,
+    visibility_timeout=settings.EVENT_QUEUE_VISIBILITY_TIMEOUT,
+    max_attempts=settings.EVENT_QUEUE_MAX_ATTEMPTS,
+    max_depth=settings.EVENT_QUEUE_MAX_DEPTH,
+)
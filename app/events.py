@@ -0,0 +1,58 @@
+from collections import Counter
+
+# Messaging event kinds, in the order they are checked
+EVENT_DELIVERY = "delivery"
+EVENT_READ = "read"
+EVENT_ECHO = "echo"
+EVENT_STICKER = "sticker"
+EVENT_IMAGE = "image"
+EVENT_TEXT = "text"
+EVENT_POSTBACK = "postback"
+EVENT_EMPTY = "empty"       # A message with neither text nor an image (e.g. video, file, location)
+EVENT_INVALID = "invalid"   # Missing sender or recipient
+EVENT_OTHER = "other"       # Reactions, referrals, optins, ...
+
+# Only these reach process_incoming_message; everything else is dropped at the webhook
+ACTIONABLE_EVENTS = frozenset({EVENT_IMAGE, EVENT_TEXT})
+
+def classify_event(event: dict) -> str:
+    """Classifies a webhook messaging event by looking at its keys only (no I/O)."""
+    if "delivery" in event:
+        return EVENT_DELIVERY
+    if "read" in event:
+        return EVENT_READ
+    if not event.get("sender", {}).get("id") or not event.get("recipient", {}).get("id"):
+        return EVENT_INVALID
+
+    message = event.get("message")
+    if message is None:
+        return EVENT_POSTBACK if "postback" in event else EVENT_OTHER
+    if message.get("is_echo"):
+        return EVENT_ECHO
+    # Stickers (including the thumbs-up "like") arrive as image attachments with a sticker_id
+    if message.get("sticker_id"):
+        return EVENT_STICKER
+    if any(attachment.get("type") == "image" for attachment in message.get("attachments", [])):
+        return EVENT_IMAGE
+    if message.get("text"):
+        return EVENT_TEXT
+    return EVENT_EMPTY
+
+class EventClassifier:
+    """Classifies events and keeps per-kind counters for this worker."""
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def classify(self, event: dict) -> str:
+        kind = classify_event(event)
+        self.counts[kind] += 1
+        return kind
+
+    def is_actionable(self, event: dict) -> bool:
+        return self.classify(event) in ACTIONABLE_EVENTS
+
+    def stats(self) -> dict:
+        return dict(self.counts)
+
+event_classifier = EventClassifier()
@@ -0,0 +1,51 @@
+import httpx
+import logging
+from typing import Optional
+from app.config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger("OmniVision")
+
+# One pooled client per worker process. Created on startup and closed on shutdown
+# so every Graph API call and image download reuses warm keep-alive connections.
+_client: Optional[httpx.AsyncClient] = None
+
+def _build_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=settings.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(
+        settings.HTTP_TIMEOUT,
+        connect=settings.HTTP_CONNECT_TIMEOUT,
+        pool=settings.HTTP_POOL_TIMEOUT,
+    )
+    http2 = settings.HTTP2_ENABLED
+    if http2:
+        try:
+            import h2  # noqa: F401  (httpx needs the optional 'h2' package for HTTP/2)
+        except ImportError:
+            logger.warning("HTTP2_ENABLED is set but the 'h2' package is missing; falling back to HTTP/1.1.")
+            http2 = False
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2, follow_redirects=True)
+
+async def init_http_client():
+    """Creates the shared client. Called from the app startup hook."""
+    global _client
+    if _client is None:
+        _client = _build_client()
+
+async def close_http_client():
+    """Closes the shared client and its pooled connections. Called on shutdown."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Returns the shared client, creating it lazily if startup has not run (e.g. in scripts)."""
+    global _client
+    if _client is None:
+        _client = _build_client()
+    return _client
@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import json
+import logging
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from app import repository
+from app.ai_engine import prepare_image
+from app.cache import DiskCache
+from app.concurrency import run_image_task
+from app.config import get_settings
+from app.http_client import get_http_client
+
+settings = get_settings()
+logger = logging.getLogger("OmniVision")
+
+class _Entry:
+    """A prepared image (see prepare_image) plus the validators of the original it was made from."""
+    __slots__ = ("data", "mime_type", "etag", "last_modified", "checked_at")
+
+    def __init__(self, data: bytes, mime_type: str, etag: Optional[str], last_modified: Optional[str], checked_at: float):
+        self.data = data
+        self.mime_type = mime_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.checked_at = checked_at
+
+    @property
+    def image(self) -> dict:
+        return {"mime_type": self.mime_type, "data": self.data}
+
+    def pack(self) -> bytes:
+        header = json.dumps({
+            "mime_type": self.mime_type, "etag": self.etag, "last_modified": self.last_modified, "checked_at": self.checked_at,
+        }).encode()
+        return struct.pack(">I", len(header)) + header + self.data
+
+    @classmethod
+    def unpack(cls, blob: bytes) -> "_Entry":
+        (header_len,) = struct.unpack(">I", blob[:4])
+        header = json.loads(blob[4:4 + header_len])
+        return cls(blob[4 + header_len:], header["mime_type"], header["etag"], header["last_modified"], header["checked_at"])
+
+class _ByteLRU:
+    """Memory tier: LRU bounded by the total size of the cached images."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._data: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[_Entry]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: _Entry):
+        if len(entry.data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old.data)
+            self._data[key] = entry
+            self.total_bytes += len(entry.data)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.total_bytes -= len(evicted.data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+class ProductImageCache:
+    """
+    Local cache of catalog product images used for visual verification. Images are stored as
+    prepared for Gemini (downscaled and re-encoded by prepare_image), a fraction of the original
+    size, so a verification does no decoding or resizing.
+
+    Memory tier (byte budget, LRU) in front of an optional disk tier. Entries younger than
+    `revalidate_after` are served without touching the network; older ones are revalidated with a
+    conditional GET (If-None-Match / If-Modified-Since), so an unchanged image costs a 304 instead
+    of a full download. If storage is unreachable, a stale copy is served.
+    """
+
+    def __init__(self, memory_bytes: int, disk_dir: str, disk_bytes: int, revalidate_after: float):
+        self.revalidate_after = revalidate_after
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._memory = _ByteLRU(memory_bytes)
+        # Disk entries are only dropped by the size budget; freshness is handled by revalidation
+        self._disk = DiskCache(disk_dir, max_bytes=disk_bytes, ttl=float("inf")) if disk_dir else None
+        self._warmed = set()
+
+    @staticmethod
+    def _key(product_id, url: str) -> str:
+        # The preparation settings are part of the key: changing them must not serve images made with the old ones
+        prep = f"{settings.IMAGE_FORMAT}|{settings.IMAGE_MAX_EDGE}|{settings.IMAGE_QUALITY}"
+        return hashlib.sha256(f"{product_id}|{url}|{prep}".encode()).hexdigest()
+
+    async def _load(self, key: str) -> Optional[_Entry]:
+        entry = self._memory.get(key)
+        if entry is None and self._disk is not None:
+            blob = await run_image_task(self._disk.get, key)
+            if blob is not None:
+                entry = _Entry.unpack(blob)
+                self._memory.set(key, entry)
+        return entry
+
+    async def _store(self, key: str, entry: _Entry):
+        self._memory.set(key, entry)
+        if self._disk is not None:
+            await run_image_task(self._disk.set, key, entry.pack())
+
+    async def get(self, product_id, url: str) -> Optional[dict]:
+        """
+        Returns the prepared product image (an inline image part), downloading or revalidating as
+        needed. None if unavailable.
+        """
+        key = self._key(product_id, url)
+        entry = await self._load(key)
+        if entry is not None and time.time() - entry.checked_at < self.revalidate_after:
+            self.hits += 1
+            return entry.image
+
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        try:
+            resp = await get_http_client().get(url, headers=headers)
+        except Exception as e:
+            logger.error("Product image download failed: %s", e)
+            return entry.image if entry is not None else None
+
+        if resp.status_code == 304 and entry is not None:
+            self.revalidated += 1
+            entry.checked_at = time.time()
+            await self._store(key, entry)
+            return entry.image
+        if resp.status_code != 200:
+            logger.warning("Product image download returned %s: %s", resp.status_code, url)
+            return entry.image if entry is not None else None
+
+        self.misses += 1
+        try:
+            image = await run_image_task(prepare_image, resp.content)
+        except Exception as e:
+            logger.error("Product image could not be prepared: %s: %s", url, e)
+            return entry.image if entry is not None else None
+        entry = _Entry(image["data"], image["mime_type"], resp.headers.get("etag"), resp.headers.get("last-modified"), time.time())
+        await self._store(key, entry)
+        return entry.image
+
+    async def put(self, product_id, url: str, image: dict):
+        """Fills the cache with an image we already prepared (e.g. right after upload)."""
+        await self._store(self._key(product_id, url), _Entry(image["data"], image["mime_type"], None, None, time.time()))
+
+    async def warm_shop(self, page_id, limit: int, concurrency: int = 8):
+        """Downloads the newest `limit` product images of a shop into the cache."""
+        self._warmed.add(str(page_id))
+        products = await repository.get_shop_product_images(page_id, limit)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _fetch(product):
+            async with semaphore:
+                await self.get(product["id"], product["image_url"])
+
+        await asyncio.gather(*[_fetch(p) for p in products if p.get("image_url")], return_exceptions=True)
+        logger.info("Warmed product image cache for shop %s (%s products)", page_id, len(products))
+
+    def warm_shop_once(self, page_id):
+        """Starts a background warm-up the first time this worker sees a shop."""
+        if str(page_id) in self._warmed:
+            return
+        self._warmed.add(str(page_id))
+        task = asyncio.create_task(self.warm_shop(page_id, settings.PRODUCT_IMAGE_CACHE_WARM_LIMIT))
+        task.add_done_callback(self._log_warm_error)
+
+    @staticmethod
+    def _log_warm_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Product image cache warm-up failed: %s", task.exception())
+
+    def stats(self) -> dict:
+        return {
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory.total_bytes,
+            "disk": self._disk.stats() if self._disk is not None else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+        }
+
+product_image_cache = ProductImageCache(
+    memory_bytes=settings.PRODUCT_IMAGE_CACHE_MEMORY_BYTES,
+    disk_dir=settings.PRODUCT_IMAGE_CACHE_DIR,
+    disk_bytes=settings.PRODUCT_IMAGE_CACHE_DISK_BYTES,
+    revalidate_after=settings.PRODUCT_IMAGE_CACHE_REVALIDATE_AFTER,
+)
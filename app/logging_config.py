@@ -0,0 +1,112 @@
+import copy
+import json
+import logging
+import logging.handlers
+import math
+import queue
+from datetime import datetime, timezone
+from numbers import Real
+from typing import Any, Optional
+
+from app.config import get_settings
+
+settings = get_settings()
+
+APP_LOGGER = "OmniVision"
+
+# Attributes every LogRecord has; anything else on a record came from `extra=` and is emitted as a field
+_RECORD_ATTRS = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "taskName"}
+
+# Number sequences at least this long are logged as a dimension/norm summary instead of their values
+VECTOR_MIN_LENGTH = 16
+
+def summarize_vector(vector) -> str:
+    """e.g. "vector(dim=768, norm=1.0000)"."""
+    norm = math.sqrt(sum(float(x) * float(x) for x in vector))
+    return f"vector(dim={len(vector)}, norm={norm:.4f})"
+
+def summarize(value: Any) -> Any:
+    """Copy of a dict/list structure with embedding-sized number lists replaced by summaries."""
+    if isinstance(value, dict):
+        return {key: summarize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if len(value) >= VECTOR_MIN_LENGTH and all(isinstance(x, Real) for x in value):
+            return summarize_vector(value)
+        return [summarize(item) for item in value]
+    return value
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, message, any `extra=` fields, and exc."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = summarize(value)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues records for the listener thread. Only the message is rendered here (the caller needs
+    its arguments captured now); JSON encoding and the write happen off the event loop.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_running = False
+
+def setup_logging():
+    """
+    Routes the app logger (LOG_LEVEL) and everything else at WARNING through one queue. Records are
+    written by a listener thread, started by start_logging(); until then they wait in the queue.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    if settings.LOG_FORMAT == "json":
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    _listener = logging.handlers.QueueListener(records, stream, respect_handler_level=True)
+
+    handler = _QueueHandler(records)
+    app_logger = logging.getLogger(APP_LOGGER)
+    app_logger.setLevel(settings.LOG_LEVEL.upper())
+    app_logger.addHandler(handler)
+    app_logger.propagate = False
+    root = logging.getLogger()
+    root.setLevel(logging.WARNING)
+    root.addHandler(handler)
+
+def start_logging():
+    """Starts the writer thread. Called from the app startup hook."""
+    global _running
+    if _listener is not None and not _running:
+        _listener.start()
+        _running = True
+
+def stop_logging():
+    """Flushes queued records and stops the writer thread. Called last from the shutdown hook."""
+    global _running
+    if _listener is not None and _running:
+        _listener.stop()
+        _running = False
@@ -2,26 +2,68 @@ from fastapi import FastAPI, Request, BackgroundTasks, HTTPException, Depends
 from fastapi.responses import PlainTextResponse, JSONResponse
 from pydantic import BaseModel
 import httpx
+import asyncio
 import logging
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from app.config import get_settings
-from app.database import supabase
-from app.ai_engine import process_image, load_models
-from app.security import encrypt_token
-
-# Logging setup
-logging.basicConfig(level=logging.INFO)
+from app import repository
+from app.credit_ledger import credit_ledger
+from app.event_queue import event_queue, EventWorkerPool, QueueFull
+from app.dedup import deduplicator
+from app.events import event_classifier
+from app import concurrency
+from app.image_cache import product_image_cache
+from app.vector_index import vector_index, MATCH_COUNT
+from app.bulk_import import bulk_importer, BulkImportError, spool_archive, spool_file, item_for_file, read_manifest, parse_url_csv, check_count
+from app.ai_engine import process_image_async, verify_visual_match_async, generate_chat_response_async, load_models, image_prep_metrics, result_cache_stats
+from app.ai_engine import verification_cache_key, get_cached_verification, verify_cache_stats, verify_text_match_async
+from app.ai_engine import embed_descriptions_async
+from app.security import encrypt_token, decrypt_token, forget_token, token_cache_stats
+from app.http_client import init_http_client, close_http_client, get_http_client
+from app.logging_config import setup_logging, start_logging, stop_logging
+
+# Logging setup (JSON lines, written off the event loop by a listener thread)
+setup_logging()
 logger = logging.getLogger("OmniVision")
 
 settings = get_settings()
 app = FastAPI(title="OmniVision API")
+event_workers: Optional[EventWorkerPool] = None
 
 # Startup event to load models
 @app.on_event("startup")
 async def startup_event():
-    # load_models() # No longer needed for API-based engine
-    pass
+    global event_workers
+    start_logging()
+    # Build the Gemini model handles once per worker
+    load_models()
+    await init_http_client()
+    if settings.CREDIT_LEDGER_ENABLED:
+        credit_ledger.start()
+    if settings.EVENT_QUEUE_ENABLED:
+        event_workers = EventWorkerPool(
+            event_queue,
+            process_incoming_message,
+            size=settings.EVENT_QUEUE_WORKERS,
+            poll_interval=settings.EVENT_QUEUE_POLL_INTERVAL,
+        )
+        event_workers.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Stop consumers first. Running events get EVENT_QUEUE_SHUTDOWN_GRACE to finish (a cancelled
+    # search would be redelivered); whatever is still unfinished goes back to the queue
+    if event_workers is not None:
+        await event_workers.stop(grace=settings.EVENT_QUEUE_SHUTDOWN_GRACE)
+        event_queue.close()
+    await deduplicator.backend.close()
+    await close_http_client()
+    if settings.CREDIT_LEDGER_ENABLED:
+        await credit_ledger.stop()
+    repository.shutdown()
+    concurrency.shutdown()
+    stop_logging()
 
 # Models for Facebook Webhook
 class WebhookEntry(BaseModel):
@@ -42,12 +84,14 @@ async def send_facebook_message(recipient_id: str, message_text: str, page_acces
         "recipient": {"id": recipient_id},
         "message": {"text": message_text}
     }
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(url, json=payload)
-            response.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            logger.error(f"Failed to send message: {e.response.text}")
+    client = get_http_client()
+    try:
+        response = await client.post(url, json=payload)
+        response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        logger.error("Failed to send message: %s", e.response.text)
+    except httpx.HTTPError as e:
+        logger.error("Failed to send message: %r", e)
 
 async def send_facebook_image(recipient_id: str, image_url: str, page_access_token: str):
     """Sends an image to a user via Facebook Graph API."""
@@ -64,23 +108,177 @@ async def send_facebook_image(recipient_id: str, image_url: str, page_access_tok
             }
         }
     }
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(url, json=payload)
-            response.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            logger.error(f"Failed to send image: {e.response.text}")
+    client = get_http_client()
+    try:
+        response = await client.post(url, json=payload)
+        response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        logger.error("Failed to send image: %s", e.response.text)
+    except httpx.HTTPError as e:
+        logger.error("Failed to send image: %r", e)
 
 async def get_shop_config(page_id: str):
     """Fetches shop configuration from Supabase."""
     try:
-        response = supabase.table("shops").select("*").eq("page_id", page_id).execute()
-        if response.data:
-            return response.data[0]
-        return None
+        return await repository.get_shop(page_id)
     except Exception as e:
-        logger.error(f"Database error: {e}")
+        logger.error("Database error: %s", e)
+        return None
+
+async def download_image(url: str) -> Optional[bytes]:
+    """Downloads a customer's image with the shared client. None if the server did not return it."""
+    resp = await get_http_client().get(url)
+    if resp.status_code != 200:
+        logger.warning("Image download returned %s", resp.status_code)
         return None
+    return resp.content
+
+async def reserve_image_credit(
+    page_id: str, shop_task: asyncio.Task, message_id: Optional[str] = None
+) -> Tuple[bool, Optional[str]]:
+    """
+    Takes the credit an image search costs. Returns (granted, owner_id charged); owner_id is None
+    when nothing was charged, e.g. for shops without an owner, which are not metered.
+    Queued events are redelivered after a failure or shutdown, so their charge is recorded by
+    message id and a redelivery that was already charged is not charged again.
+    """
+    tracked = bool(message_id) and settings.EVENT_QUEUE_ENABLED
+    if tracked:
+        try:
+            owner_id = await event_queue.get_charge(message_id)
+        except Exception as e:
+            logger.error("Charge lookup for message %s failed: %s", message_id, e)
+            owner_id = None
+        if owner_id:
+            logger.info("Message %s was already charged to user %s", message_id, owner_id)
+            return True, owner_id
+
+    granted, owner_id = await _charge_image_credit(page_id, shop_task)
+    if tracked and granted and owner_id:
+        try:
+            await event_queue.record_charge(message_id, owner_id)
+        except Exception as e:
+            logger.error("Recording the charge for message %s failed: %s", message_id, e)
+    return granted, owner_id
+
+async def _charge_image_credit(page_id: str, shop_task: asyncio.Task) -> Tuple[bool, Optional[str]]:
+    if settings.CREDIT_LEDGER_ENABLED:
+        # The ledger is keyed by owner, so this waits for the shop row (usually cached)
+        shop_config = await asyncio.shield(shop_task)
+        if not shop_config:
+            return False, None
+        owner_id = shop_config.get("owner_id")
+        if not owner_id:
+            return True, None
+        # Spend from this worker's reserved allowance; the DB is written in batches
+        return await credit_ledger.consume(owner_id), owner_id
+
+    # Resolve the owner from the page and deduct atomically, without waiting for the shop row
+    charge = await repository.reserve_credit_for_page(page_id)
+    if charge is None:
+        return False, None
+    if charge["owner_id"]:
+        logger.info("Deducted 1 credit from user %s, %s left", charge['owner_id'], charge['credits'])
+    return True, charge["owner_id"]
+
+async def refund_image_credit(owner_id: str, message_id: Optional[str] = None):
+    """Gives back a credit taken for a search that never ran."""
+    try:
+        if settings.CREDIT_LEDGER_ENABLED:
+            credit_ledger.refund(owner_id)
+        else:
+            await repository.release_credits({owner_id: 1})
+        logger.info("Refunded 1 credit to user %s", owner_id)
+        if message_id and settings.EVENT_QUEUE_ENABLED:
+            # Nothing is paid for this message any more; a redelivery has to charge again
+            await event_queue.clear_charge(message_id)
+    except Exception as e:
+        logger.error("Credit refund for user %s failed: %s", owner_id, e)
+
+async def process_image_message(sender_id: str, page_id: str, image_url: str, message_id: Optional[str] = None):
+    """
+    Image path of process_incoming_message. The image download, shop lookup and credit
+    reservation do not depend on each other, so all three start at once. The first one to fail
+    cancels the others, and a credit that was already taken is refunded.
+    """
+    shop_task = asyncio.create_task(get_shop_config(page_id))
+    credit_task = asyncio.create_task(reserve_image_credit(page_id, shop_task, message_id))
+    download_task = asyncio.create_task(download_image(image_url))
+    succeeded = {
+        shop_task: lambda shop_config: shop_config is not None,
+        credit_task: lambda charge: charge[0],
+        download_task: lambda image_bytes: image_bytes is not None,
+    }
+
+    failed = None
+    try:
+        try:
+            pending = set(succeeded)
+            while pending and failed is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None or not succeeded[task](task.result()):
+                        failed = task
+                        break
+        finally:
+            # Stop what is no longer needed (a no-op for finished tasks). A failed download is still
+            # reported to the customer, which needs the shop row. The credit reservation is never
+            # cancelled: its deduction could land after we stopped waiting for it.
+            if failed is not download_task:
+                download_task.cancel()
+                if failed is not shop_task:
+                    shop_task.cancel()
+            await asyncio.gather(shop_task, download_task, return_exceptions=True)
+
+        # The reservation always completes, so whether a credit was taken is known here
+        try:
+            granted, charged_owner = await asyncio.shield(credit_task)
+        except Exception as e:
+            logger.error("Error checking credits: %s", e)
+            granted, charged_owner = False, None
+    except asyncio.CancelledError:
+        # Cancelled before the search started (worker shutdown or the queue's time limit): the
+        # event is redelivered, so give back the credit this attempt took
+        try:
+            granted, charged_owner = await asyncio.shield(credit_task)
+        except BaseException:
+            # Failed, or it was waiting on the shop lookup cancelled above: nothing was taken
+            granted, charged_owner = False, None
+        if granted and charged_owner:
+            await refund_image_credit(charged_owner, message_id)
+        raise
+
+    if failed is None:
+        shop_config = shop_task.result()
+        try:
+            page_access_token = decrypt_token(shop_config["encrypted_access_token"])
+        except Exception as e:
+            logger.error("Token decryption failed: %s", e)
+            if charged_owner:
+                await refund_image_credit(charged_owner, message_id)
+            return
+        await handle_image_search(sender_id, download_task.result(), page_id, shop_config, page_access_token)
+        return
+
+    if granted and charged_owner:
+        await refund_image_credit(charged_owner, message_id)
+
+    if failed is shop_task:
+        logger.warning("Shop not found for Page ID: %s", page_id)
+    elif failed is credit_task:
+        if credit_task.exception() is None:
+            logger.warning("Insufficient credits (or unknown user) for Page ID %s", page_id)
+    else:
+        if download_task.exception() is not None:
+            logger.error("Image download failed: %s", download_task.exception())
+        shop_config = shop_task.result()
+        if shop_config:
+            try:
+                page_access_token = decrypt_token(shop_config["encrypted_access_token"])
+            except Exception as e:
+                logger.error("Token decryption failed: %s", e)
+                return
+            await send_facebook_message(sender_id, "Failed to download image.", page_access_token)
 
 async def process_incoming_message(event: dict):
     """Background task to process the incoming message."""
@@ -91,57 +289,48 @@ async def process_incoming_message(event: dict):
     if not sender_id or not recipient_id:
         return
 
+    # First image attachment, if any. Only the first image is processed for now.
+    image_url = None
+    for attachment in message.get("attachments", []):
+        if attachment.get("type") == "image":
+            image_url = attachment["payload"]["url"]
+            break
+
+    if image_url:
+        await process_image_message(sender_id, recipient_id, image_url, message.get("mid"))
+        return
+
     # Fetch shop config to get access token
     shop_config = await get_shop_config(recipient_id)
     if not shop_config:
-        logger.warning(f"Shop not found for Page ID: {recipient_id}")
+        logger.warning("Shop not found for Page ID: %s", recipient_id)
         return
-    
+
     # Check Credits
     owner_id = shop_config.get("owner_id")
-    credits = 0
     if owner_id:
         try:
-            user_resp = supabase.table("users").select("credits").eq("facebook_user_id", owner_id).execute()
-            if user_resp.data:
-                credits = user_resp.data[0]["credits"]
-                if credits <= 0:
-                    logger.warning(f"Insufficient credits for User {owner_id}")
-                    # Optional: Send message to user saying "Out of credits"
-                    return
-            else:
-                logger.warning(f"User {owner_id} not found in users table.")
+            credits = await repository.get_user_credits(owner_id)
+            if credits is None:
+                logger.warning("User %s not found in users table.", owner_id)
                 # If user not found, maybe allow or block? Let's block to be safe.
                 return
+            if credits <= 0:
+                logger.warning("Insufficient credits for User %s", owner_id)
+                # Optional: Send message to user saying "Out of credits"
+                return
         except Exception as e:
-            logger.error(f"Error checking credits: {e}")
+            logger.error("Error checking credits: %s", e)
             return
 
     # Decrypt token
-    from app.security import decrypt_token
     try:
         page_access_token = decrypt_token(shop_config["encrypted_access_token"])
     except Exception as e:
-        logger.error(f"Token decryption failed: {e}")
+        logger.error("Token decryption failed: %s", e)
         return
 
-    if "attachments" in message:
-        for attachment in message["attachments"]:
-            if attachment["type"] == "image":
-                image_url = attachment["payload"]["url"]
-                
-                # Deduct Credit
-                if owner_id:
-                    try:
-                        supabase.table("users").update({"credits": credits - 1}).eq("facebook_user_id", owner_id).execute()
-                        logger.info(f"Deducted 1 credit from user {owner_id}")
-                    except Exception as e:
-                        logger.error(f"Failed to deduct credit: {e}")
-                
-                await handle_image_search(sender_id, image_url, recipient_id, shop_config, page_access_token)
-                return # Only process first image for now
-
-    elif "text" in message:
+    if "text" in message:
         if shop_config.get("service_chat", False):
             await handle_text_chat(sender_id, message["text"], recipient_id, shop_config, page_access_token)
         else:
@@ -152,76 +341,119 @@ async def handle_text_chat(user_id: str, message_text: str, page_id: str, shop_c
     """Handles text chat using Gemini."""
     try:
         # Run AI Chat
-        import asyncio
-        from app.ai_engine import generate_chat_response
-        
         context = shop_config.get("chat_context", "")
-        loop = asyncio.get_running_loop()
-        reply_text = await loop.run_in_executor(None, generate_chat_response, message_text, context)
+        reply_text = await generate_chat_response_async(message_text, context)
         
         await send_facebook_message(user_id, reply_text, token)
     except Exception as e:
-        logger.error(f"Error in text chat: {e}")
+        logger.error("Error in text chat: %s", e)
         await send_facebook_message(user_id, "I'm having trouble connecting to my brain right now.", token)
 
-async def handle_image_search(user_id: str, image_url: str, page_id: str, shop_config: dict, token: str):
-    """Downloads image, runs AI, finds matches, and replies."""
+async def verify_candidate(ai_result: dict, candidate: dict) -> int:
+    """Scores (0-100) how likely a matched product is the item in the customer's image."""
+    # Text tier: compare descriptions first and only send ambiguous cases to the image comparison
+    query_description = ai_result.get("description")
+    candidate_description = candidate.get("description")
+    if settings.VERIFY_MODE == "text_first" and query_description and candidate_description:
+        text_score = await verify_text_match_async(query_description, candidate_description)
+        logger.info("Text Verification Score: %s", text_score)
+        if text_score >= settings.TEXT_VERIFY_ACCEPT or text_score <= settings.TEXT_VERIFY_REJECT:
+            return text_score
+
+    # --- Visual Verification Step ---
+    # Same query image vs. same product seen recently: reuse the score, skip download and Gemini
+    query_hash = ai_result.get("image_hash")
+    verify_key = verification_cache_key(query_hash, candidate) if query_hash else None
+    cached_score = get_cached_verification(verify_key) if verify_key else None
+    if cached_score is not None:
+        return cached_score
+
+    query_image = ai_result.get("image")
+    if query_image is None:
+        return 0
     try:
-        # Download image
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(image_url)
-            if resp.status_code != 200:
-                await send_facebook_message(user_id, "Failed to download image.", token)
-                return
-            image_bytes = resp.content
-
-        # Run AI Pipeline
-        # This is synchronous CPU intensive work, ideally run in a threadpool or separate worker
-        # FastAPI BackgroundTasks run in the same event loop if async, or threadpool if sync def.
-        # process_image is sync, so it blocks. We should run it in a thread.
-        import asyncio
-        from functools import partial
-        
-        loop = asyncio.get_running_loop()
-        ai_result = await loop.run_in_executor(None, process_image, image_bytes)
+        # Download candidate image (served, already prepared, from the local product image cache when possible)
+        candidate_image = await product_image_cache.get(candidate["id"], candidate["image_url"])
+        if candidate_image is not None:
+            # Run Verification
+            return await verify_visual_match_async(query_image, candidate_image, cache_key=verify_key)
+    except Exception as e:
+        logger.error("Verification download failed: %s", e)
+    return 0
+
+async def verify_top_candidates(ai_result: dict, matches: List[dict]):
+    """
+    Verifies the best VERIFY_TOP_N matches concurrently (at most VERIFY_TOP_N_CONCURRENCY at once)
+    and returns (match, score) for the highest score. As soon as one candidate reaches the exact-match
+    score (85) the remaining downloads and verifications are cancelled.
+    """
+    candidates = matches[:max(settings.VERIFY_TOP_N, 1)]
+    if len(candidates) == 1:
+        return candidates[0], await verify_candidate(ai_result, candidates[0])
+
+    semaphore = asyncio.Semaphore(max(settings.VERIFY_TOP_N_CONCURRENCY, 1))
+
+    async def _verify(rank: int, candidate: dict):
+        async with semaphore:
+            return rank, await verify_candidate(ai_result, candidate)
+
+    tasks = [asyncio.create_task(_verify(rank, candidate)) for rank, candidate in enumerate(candidates)]
+    best_rank, best_score = 0, -1
+    try:
+        for finished in asyncio.as_completed(tasks):
+            rank, score = await finished
+            logger.info("Candidate %s verification score: %s", rank + 1, score)
+            # Higher score wins; on a tie the better-ranked match does
+            if score > best_score or (score == best_score and rank < best_rank):
+                best_rank, best_score = rank, score
+            if score >= 85:
+                break
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    return candidates[best_rank], best_score
+
+async def handle_image_search(user_id: str, image_bytes: bytes, page_id: str, shop_config: dict, token: str):
+    """Runs AI on the downloaded customer image, finds matches, and replies."""
+    try:
+        # Run AI Pipeline (native async Gemini calls, no thread held while waiting)
+        ai_result = await process_image_async(image_bytes)
         
-        siglip_emb = ai_result["siglip_embedding"]
-        dino_emb = ai_result["dino_embedding"]
-
         # Search in Database
-        # match_products(query_siglip, query_dino, match_threshold, filter_page_id)
+        # match_products(query_embedding, match_threshold, filter_page_id)
         params = {
-            "query_siglip": siglip_emb,
-            "query_dino": dino_emb,
+            "query_embedding": ai_result["embedding"],
             "match_threshold": 0.70,
             "filter_page_id": int(page_id)
         }
         
-        # Supabase rpc call
-        logger.info(f"Calling match_products with params: {params}")
-        rpc_response = supabase.rpc("match_products", params).execute()
-        matches = rpc_response.data
-        logger.info(f"Matches found: {matches}")
+        # First search for this shop in this worker: pull its catalog images in the background
+        product_image_cache.warm_shop_once(page_id)
 
-        if matches:
-            top_match = matches[0]
-            # --- Visual Verification Step ---
-            # Download candidate image
-            candidate_url = top_match["image_url"]
-            verification_score = 0
+        # Search the shop's in-process index; the Supabase RPC stays as the fallback
+        matches = None
+        if settings.VECTOR_INDEX_ENABLED:
             try:
-                async with httpx.AsyncClient() as client:
-                    c_resp = await client.get(candidate_url)
-                    if c_resp.status_code == 200:
-                        candidate_bytes = c_resp.content
-                        
-                        # Run Verification
-                        from app.ai_engine import verify_visual_match
-                        verification_score = await loop.run_in_executor(None, verify_visual_match, image_bytes, candidate_bytes)
+                matches = await vector_index.search(
+                    page_id, params["query_embedding"], params["match_threshold"], k=MATCH_COUNT
+                )
             except Exception as e:
-                logger.error(f"Verification download failed: {e}")
+                logger.error("Vector index search failed for shop %s, using match_products: %s", page_id, e)
+        if matches is None:
+            # Structured fields are summarized by the log writer: vectors become dim/norm, not 768 floats
+            logger.info("Calling match_products for shop %s", page_id, extra={"params": params})
+            matches = await repository.match_products(params)
+        logger.info(
+            "Matches found: %s", len(matches),
+            extra={"matches": [{"id": m.get("id"), "similarity": m.get("similarity")} for m in matches]},
+        )
 
-            logger.info(f"Final Verification Score: {verification_score}")
+        if matches:
+            top_match, verification_score = await verify_top_candidates(ai_result, matches)
+
+            logger.info("Final Verification Score: %s", verification_score)
 
             # Filter based on score
             if verification_score < 65:
@@ -248,7 +480,7 @@ async def handle_image_search(user_id: str, image_url: str, page_id: str, shop_c
                     confidence=confidence_pct
                 )
             except Exception as e:
-                logger.error(f"Template format error: {e}")
+                logger.error("Template format error: %s", e)
                 reply_text = f"Found {top_match.get('name')}."
             
             await send_facebook_message(user_id, reply_text, token)
@@ -261,9 +493,7 @@ async def handle_image_search(user_id: str, image_url: str, page_id: str, shop_c
             await send_facebook_message(user_id, msg_not_found, token)
 
     except Exception as e:
-        logger.error(f"Error in search pipeline: {repr(e)}") # Use repr to see full error
-        import traceback
-        logger.error(traceback.format_exc())
+        logger.exception("Error in search pipeline: %r", e) # Use repr to see full error
         await send_facebook_message(user_id, "An error occurred while processing your image.", token)
 
 # --- Routes ---
@@ -272,6 +502,24 @@ async def handle_image_search(user_id: str, image_url: str, page_id: str, shop_c
 def health_check():
     return {"status": "ok", "service": "OmniVision"}
 
+@app.get("/metrics")
+async def metrics():
+    """In-process counters for this worker."""
+    return {
+        "shop_cache": repository.shop_cache.stats(),
+        "token_cache": token_cache_stats(),
+        "credit_ledger": credit_ledger.stats(),
+        "dedup": deduplicator.stats(),
+        "webhook_events": event_classifier.stats(),
+        "ai_concurrency": concurrency.concurrency_stats(),
+        "image_prep": image_prep_metrics(),
+        "result_cache": result_cache_stats(),
+        "verify_cache": verify_cache_stats(),
+        "product_image_cache": product_image_cache.stats(),
+        "vector_index": vector_index.stats(),
+        "event_queue": {**(await event_queue.stats()), **event_workers.stats()} if event_workers else None,
+    }
+
 @app.get("/webhook")
 async def verify_webhook(request: Request):
     """Facebook Webhook verification."""
@@ -285,7 +533,7 @@ async def verify_webhook(request: Request):
             logger.info("Webhook verified successfully.")
             return PlainTextResponse(content=challenge, status_code=200)
         else:
-            logger.warning(f"Webhook verification failed. Token: {token}, Expected: {settings.FACEBOOK_VERIFY_TOKEN}")
+            logger.warning("Webhook verification failed. Token: %s, Expected: %s", token, settings.FACEBOOK_VERIFY_TOKEN)
             raise HTTPException(status_code=403, detail="Verification failed")
     return HTTPException(status_code=400, detail="Missing parameters")
 
@@ -295,15 +543,38 @@ async def webhook_handler(request: Request, background_tasks: BackgroundTasks):
     try:
         body = await request.json()
         if body.get("object") == "page":
+            events = []
             for entry in body.get("entry", []):
                 for messaging_event in entry.get("messaging", []):
+                    # Receipts, echoes, stickers etc. need no work; drop them before any I/O
+                    if not event_classifier.is_actionable(messaging_event):
+                        continue
+                    # Facebook redelivers batches on timeouts; drop message ids we already accepted
+                    if await deduplicator.is_duplicate(messaging_event):
+                        continue
+                    events.append(messaging_event)
+            if settings.EVENT_QUEUE_ENABLED:
+                # Persist and acknowledge; the worker pool processes them
+                try:
+                    await event_queue.append(events)
+                except Exception:
+                    # Not handed off, so the redelivery must not be treated as a duplicate
+                    for messaging_event in events:
+                        await deduplicator.forget(messaging_event)
+                    raise
+            else:
+                for messaging_event in events:
                     # Add processing to background task to respond quickly to FB
                     background_tasks.add_task(process_incoming_message, messaging_event)
             return PlainTextResponse(content="EVENT_RECEIVED", status_code=200)
         else:
             raise HTTPException(status_code=404, detail="Not a page event")
+    except QueueFull as e:
+        # Backpressure: Facebook redelivers later instead of us buffering without bound
+        logger.warning("Webhook rejected: %s", e)
+        return PlainTextResponse(content="QUEUE_FULL", status_code=503)
     except Exception as e:
-        logger.error(f"Webhook error: {e}")
+        logger.error("Webhook error: %s", e)
         # Return 200 to prevent FB from retrying indefinitely on bad logic
         return PlainTextResponse(content="EVENT_RECEIVED", status_code=200)
 
@@ -331,8 +602,13 @@ async def onboard_shop(shop: ShopOnboard):
         data["owner_id"] = shop.owner_id
     
     try:
+        # Re-onboarding replaces the token, so drop the old plaintext from memory
+        previous = await get_shop_config(str(shop.page_id))
+        if previous:
+            forget_token(previous.get("encrypted_access_token"))
+
         # 1. Save to DB
-        response = supabase.table("shops").upsert(data).execute()
+        shop_rows = await repository.upsert_shop(data)
         
         # 2. Subscribe App to Page Webhooks
         # This ensures we receive messages for this page
@@ -341,14 +617,14 @@ async def onboard_shop(shop: ShopOnboard):
             "access_token": shop.access_token,
             "subscribed_fields": "messages,messaging_postbacks"
         }
-        async with httpx.AsyncClient() as client:
-            sub_resp = await client.post(subscribe_url, params=subscribe_params)
-            if sub_resp.status_code != 200:
-                logger.error(f"Failed to subscribe app to page {shop.page_id}: {sub_resp.text}")
-                # We don't raise error here to allow onboarding to complete, but we log it.
-                # In production, we might want to return a warning.
-
-        return {"status": "success", "data": response.data}
+        client = get_http_client()
+        sub_resp = await client.post(subscribe_url, params=subscribe_params)
+        if sub_resp.status_code != 200:
+            logger.error("Failed to subscribe app to page %s: %s", shop.page_id, sub_resp.text)
+            # We don't raise error here to allow onboarding to complete, but we log it.
+            # In production, we might want to return a warning.
+
+        return {"status": "success", "data": shop_rows}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -370,23 +646,14 @@ async def add_product(
     import uuid
     filename = f"{shop_id}/{uuid.uuid4()}.jpg"
     try:
-        # Upload
-        supabase.storage.from_("products").upload(
-            path=filename,
-            file=image_bytes,
-            file_options={"content-type": "image/jpeg"}
-        )
-        # Get Public URL
-        image_url = supabase.storage.from_("products").get_public_url(filename)
+        # Upload and get Public URL
+        image_url = await repository.upload_product_image(filename, image_bytes, "image/jpeg")
     except Exception as e:
-        logger.error(f"Storage upload failed: {e}")
+        logger.error("Storage upload failed: %s", e)
         raise HTTPException(status_code=500, detail="Failed to upload image")
 
     # 3. Generate Embeddings
-    # Run sync function in executor
-    import asyncio
-    loop = asyncio.get_running_loop()
-    ai_result = await loop.run_in_executor(None, process_image, image_bytes)
+    ai_result = await process_image_async(image_bytes)
     
     # 4. Save to DB
     data = {
@@ -394,25 +661,123 @@ async def add_product(
         "name": name,
         "price": price,
         "image_url": image_url,
-        "siglip_embedding": ai_result["siglip_embedding"],
-        "dino_embedding": ai_result["dino_embedding"]
+        "embedding": ai_result["embedding"],
+        "description": ai_result.get("description")
     }
     
     try:
-        response = supabase.table("products").insert(data).execute()
-        return {"status": "created", "product": response.data}
+        product_rows = await repository.insert_product(data)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    # We already hold the prepared image, so verification never has to download it
+    if product_rows:
+        vector_index.add_product(product_rows[0])
+        if ai_result.get("image") is not None:
+            await product_image_cache.put(product_rows[0]["id"], image_url, ai_result["image"])
+    return {"status": "created", "product": product_rows}
+
+@app.post("/shops/{page_id}/products/bulk")
+async def bulk_import_products(
+    page_id: int,
+    background_tasks: BackgroundTasks,
+    archive: Optional[UploadFile] = File(None),
+    files: Optional[List[UploadFile]] = File(None),
+    csv_file: Optional[UploadFile] = File(None),
+    manifest: Optional[UploadFile] = File(None),
+    default_price: float = Form(0.0)
+):
+    """
+    Bulk product import. Send exactly one of:
+    - archive: a zip of images, optionally with a manifest.csv (filename,name,price)
+    - files: several images, optionally with a manifest CSV upload
+    - csv_file: a CSV of name,price,image_url
+    Items without a manifest row are named after the file and priced at default_price.
+    Returns a job id; follow it with GET /imports/{job_id}.
+    """
+    if sum(source is not None and source != [] for source in (archive, files, csv_file)) != 1:
+        raise HTTPException(status_code=400, detail="Send exactly one of archive, files or csv_file")
+
+    import uuid
+    job_id = uuid.uuid4().hex
+    job_dir = bulk_importer.job_dir(job_id)
+    try:
+        if archive is not None:
+            items = await concurrency.run_image_task(spool_archive, job_dir, archive.file, default_price)
+        elif csv_file is not None:
+            items = parse_url_csv(await csv_file.read())
+        else:
+            check_count(len(files))
+            manifest_rows = read_manifest(await manifest.read()) if manifest is not None else {}
+            items = []
+            for i, upload in enumerate(files):
+                path = await concurrency.run_image_task(spool_file, job_dir, i, upload.filename, await upload.read())
+                items.append(item_for_file(upload.filename, path, manifest_rows, default_price))
+        await bulk_importer.create_job(page_id, items, job_id)
+    except BulkImportError as e:
+        await bulk_importer.discard_files(job_id)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception:
+        await bulk_importer.discard_files(job_id)
+        raise
+
+    background_tasks.add_task(bulk_importer.run_job, job_id)
+    return {"status": "accepted", "job_id": job_id, "total": len(items)}
+
+@app.get("/imports/{job_id}")
+async def get_import_job(job_id: str):
+    """Import progress: item counts, recent errors and, while running in this worker, per-stage throughput."""
+    job = await bulk_importer.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    return job
+
+@app.post("/imports/{job_id}/resume")
+async def resume_import_job(job_id: str, background_tasks: BackgroundTasks, force: bool = False):
+    """Re-runs every item of a job that is not done. Use force=true for a job left 'running' by a dead worker."""
+    job = await bulk_importer.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    if bulk_importer.is_running(job_id) or (job["status"] == "running" and not force):
+        raise HTTPException(status_code=409, detail="Import job is already running")
+    background_tasks.add_task(bulk_importer.run_job, job_id)
+    return {"status": "resumed", "job_id": job_id, "remaining": job["items"]["pending"] + job["items"]["failed"]}
+
 @app.get("/shops/{page_id}/products")
 async def get_shop_products(page_id: int):
     """Get all products for a specific shop."""
     try:
-        response = supabase.table("products").select("*").eq("shop_id", page_id).order("created_at", desc=True).execute()
-        return response.data
+        return await repository.get_shop_products(page_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def reembed_products(page_id: int):
+    """Recomputes every product embedding of a shop from its stored description, in batches."""
+    products = [p for p in await repository.get_shop_product_descriptions(page_id) if p.get("description")]
+    if not products:
+        return
+    embeddings = await embed_descriptions_async([p["description"] for p in products])
+
+    semaphore = asyncio.Semaphore(settings.DB_MAX_WORKERS)
+    async def _update(product, embedding):
+        async with semaphore:
+            await repository.update_product(product["id"], {"embedding": embedding})
+    await asyncio.gather(*[_update(p, e) for p, e in zip(products, embeddings)])
+    vector_index.invalidate(page_id)
+    logger.info("Re-embedded %s products for shop %s", len(products), page_id)
+
+@app.post("/shops/{page_id}/products/reembed")
+async def reembed_shop_products(page_id: int, background_tasks: BackgroundTasks):
+    """Re-embeds a shop's catalog (e.g. after changing GEMINI_EMBEDDING_MODEL). Products without a stored description are skipped."""
+    background_tasks.add_task(reembed_products, page_id)
+    return {"status": "scheduled"}
+
+@app.post("/shops/{page_id}/image-cache/warm")
+async def warm_product_image_cache(page_id: int, background_tasks: BackgroundTasks):
+    """Pre-fetches a shop's product images into this worker's verification cache."""
+    background_tasks.add_task(product_image_cache.warm_shop, page_id, settings.PRODUCT_IMAGE_CACHE_WARM_LIMIT)
+    return {"status": "scheduled"}
+
 # --- User & Shop Management API (For PHP Frontend) ---
 
 class UserCreate(BaseModel):
@@ -430,31 +795,29 @@ async def create_or_update_user(user: UserCreate):
     }
     try:
         # Upsert: Insert or Update on conflict
-        response = supabase.table("users").upsert(data).execute()
-        return response.data
+        return await repository.upsert_user(data)
     except Exception as e:
-        logger.error(f"Error creating user: {e}")
+        logger.error("Error creating user: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/users/{user_id}")
 async def get_user(user_id: str):
     """Get user details (credits)."""
     try:
-        response = supabase.table("users").select("*").eq("facebook_user_id", user_id).execute()
-        if not response.data:
-            raise HTTPException(status_code=404, detail="User not found")
-        return response.data[0]
+        user = await repository.get_user(user_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
 
 @app.get("/users/{user_id}/shops")
 async def get_user_shops(user_id: str):
     """Get shops owned by user."""
     try:
-        response = supabase.table("shops").select("page_id").eq("owner_id", user_id).execute()
         # We only return IDs here. Frontend fetches names from FB Graph.
         # Or we could store names in DB. For now, just IDs.
-        return [row['page_id'] for row in response.data]
+        return await repository.get_shop_page_ids(user_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -462,12 +825,13 @@ async def get_user_shops(user_id: str):
 async def get_shop_details(page_id: int):
     """Get shop config."""
     try:
-        response = supabase.table("shops").select("*").eq("page_id", page_id).execute()
-        if not response.data:
-            raise HTTPException(status_code=404, detail="Shop not found")
-        return response.data[0]
+        # The dashboard always reads the current row, not the webhook cache
+        shop_config = await repository.get_shop(page_id, use_cache=False)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if not shop_config:
+        raise HTTPException(status_code=404, detail="Shop not found")
+    return shop_config
 
 class ShopUpdate(BaseModel):
     msg_found: str
@@ -491,8 +855,7 @@ async def update_shop_details(page_id: int, shop: ShopUpdate):
             "service_chat": shop.service_chat,
             "chat_context": shop.chat_context
         }
-        response = supabase.table("shops").update(data).eq("page_id", page_id).execute()
-        return response.data
+        return await repository.update_shop(page_id, data)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -503,21 +866,23 @@ async def delete_shop(page_id: int):
         # 1. Get Access Token to Unsubscribe
         shop_config = await get_shop_config(str(page_id))
         if shop_config:
-            from app.security import decrypt_token
             try:
                 page_access_token = decrypt_token(shop_config["encrypted_access_token"])
                 
                 # 2. Unsubscribe from Facebook Webhooks
                 unsubscribe_url = f"https://graph.facebook.com/v18.0/{page_id}/subscribed_apps"
-                async with httpx.AsyncClient() as client:
-                    await client.delete(unsubscribe_url, params={"access_token": page_access_token})
-                    logger.info(f"Unsubscribed app from page {page_id}")
+                client = get_http_client()
+                await client.delete(unsubscribe_url, params={"access_token": page_access_token})
+                logger.info("Unsubscribed app from page %s", page_id)
             except Exception as e:
-                logger.error(f"Failed to unsubscribe page {page_id}: {e}")
+                logger.error("Failed to unsubscribe page %s: %s", page_id, e)
                 # Continue to delete from DB even if unsubscribe fails
 
         # 3. Delete from Database
-        response = supabase.table("shops").delete().eq("page_id", page_id).execute()
+        await repository.delete_shop(page_id)
+        vector_index.invalidate(page_id)
+        if shop_config:
+            forget_token(shop_config.get("encrypted_access_token"))
         return {"status": "success", "message": f"Shop {page_id} disconnected"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
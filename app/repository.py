@@ -0,0 +1,197 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+
+from app.cache import TTLCache
+from app.config import get_settings
+from app.database import supabase
+
+settings = get_settings()
+logger = logging.getLogger("OmniVision")
+
+# The supabase-py client is synchronous. Every query is pushed onto this bounded pool so a
+# slow round-trip never blocks the event loop, and a burst of queries cannot grow threads unbounded.
+_db_executor = ThreadPoolExecutor(max_workers=settings.DB_MAX_WORKERS, thread_name_prefix="db")
+
+async def _run(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, partial(fn, *args, **kwargs))
+
+# Shop rows keyed by str(page_id). Webhooks pass page ids as strings, routes as ints.
+shop_cache = TTLCache(maxsize=settings.SHOP_CACHE_MAX_SIZE, ttl=settings.SHOP_CACHE_TTL)
+
+def shutdown():
+    """Stops the DB thread pool. Called from the app shutdown hook."""
+    _db_executor.shutdown(wait=False)
+
+# --- Shops ---
+
+async def get_shop(page_id, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+    """Returns the shop row for a page, or None. Cached rows are served for up to SHOP_CACHE_TTL."""
+    key = str(page_id)
+    if use_cache:
+        cached = shop_cache.get(key)
+        if cached is not None:
+            return cached
+    response = await _run(lambda: supabase.table("shops").select("*").eq("page_id", page_id).execute())
+    if response.data:
+        shop_cache.set(key, response.data[0])
+        return response.data[0]
+    return None
+
+def invalidate_shop(page_id):
+    """Drops a shop from this worker's cache after its row changed."""
+    shop_cache.pop(str(page_id))
+
+async def get_shop_page_ids(owner_id: str) -> List[int]:
+    """Returns the page ids owned by a user."""
+    response = await _run(lambda: supabase.table("shops").select("page_id").eq("owner_id", owner_id).execute())
+    return [row["page_id"] for row in response.data]
+
+async def upsert_shop(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    try:
+        response = await _run(lambda: supabase.table("shops").upsert(data).execute())
+    finally:
+        invalidate_shop(data["page_id"])
+    return response.data
+
+async def update_shop(page_id, data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    try:
+        response = await _run(lambda: supabase.table("shops").update(data).eq("page_id", page_id).execute())
+    finally:
+        invalidate_shop(page_id)
+    return response.data
+
+async def delete_shop(page_id) -> List[Dict[str, Any]]:
+    try:
+        response = await _run(lambda: supabase.table("shops").delete().eq("page_id", page_id).execute())
+    finally:
+        invalidate_shop(page_id)
+    return response.data
+
+# --- Users & Credits ---
+
+async def get_user(user_id: str) -> Optional[Dict[str, Any]]:
+    response = await _run(lambda: supabase.table("users").select("*").eq("facebook_user_id", user_id).execute())
+    if response.data:
+        return response.data[0]
+    return None
+
+async def upsert_user(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    response = await _run(lambda: supabase.table("users").upsert(data).execute())
+    return response.data
+
+async def get_user_credits(user_id: str) -> Optional[int]:
+    """Returns the user's credit balance, or None if the user does not exist."""
+    response = await _run(lambda: supabase.table("users").select("credits").eq("facebook_user_id", user_id).execute())
+    if response.data:
+        return response.data[0]["credits"]
+    return None
+
+async def reserve_credit(user_id: str, amount: int = 1) -> Optional[int]:
+    """
+    Atomically deducts credits if the balance covers them (see the reserve_credit SQL function).
+    Returns the new balance, or None if the user is missing or has insufficient credits.
+    Image searches reserve by page with reserve_credit_for_page; this owner-keyed variant is the
+    credit ledger's fallback when the balance is too low to hand out blocks.
+    """
+    response = await _run(lambda: supabase.rpc("reserve_credit", {"p_owner_id": user_id, "p_amount": amount}).execute())
+    return response.data
+
+async def reserve_credit_for_page(page_id, amount: int = 1) -> Optional[Dict[str, Any]]:
+    """
+    Deducts credits from the owner of a page without fetching the shop first (see the
+    reserve_credit_for_page SQL function). Returns {"owner_id", "credits"} on success, with
+    owner_id None for shops without an owner (not metered); None if the page is unknown or
+    the owner is missing or has insufficient credits.
+    """
+    response = await _run(
+        lambda: supabase.rpc("reserve_credit_for_page", {"p_page_id": int(page_id), "p_amount": amount}).execute()
+    )
+    return response.data[0] if response.data else None
+
+async def reserve_credits_block(user_id: str, max_amount: int, workers: int = 1) -> int:
+    """
+    Deducts a block of max_amount credits if the balance covers one for each worker, and returns
+    how many were granted (0 when it does not; callers then reserve single credits).
+    """
+    response = await _run(
+        lambda: supabase.rpc(
+            "reserve_credits_block", {"p_owner_id": user_id, "p_max": max_amount, "p_workers": workers}
+        ).execute()
+    )
+    return response.data or 0
+
+async def release_credits(deltas: Dict[str, int]) -> None:
+    """Adds unused reserved credits back, batched as {owner_id: amount}."""
+    if deltas:
+        await _run(lambda: supabase.rpc("release_credits", {"p_deltas": deltas}).execute())
+
+# --- Products ---
+
+async def upload_product_image(path: str, image_bytes: bytes, content_type: str = "image/jpeg") -> str:
+    """Uploads an image to the 'products' bucket and returns its public URL."""
+    def _upload():
+        bucket = supabase.storage.from_("products")
+        bucket.upload(path=path, file=image_bytes, file_options={"content-type": content_type})
+        return bucket.get_public_url(path)
+    return await _run(_upload)
+
+async def insert_product(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    response = await _run(lambda: supabase.table("products").insert(data).execute())
+    return response.data
+
+async def insert_products(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Inserts several products in one request; returns the rows in input order."""
+    response = await _run(lambda: supabase.table("products").insert(rows).execute())
+    return response.data
+
+async def get_shop_products(shop_id) -> List[Dict[str, Any]]:
+    response = await _run(
+        lambda: supabase.table("products").select("*").eq("shop_id", shop_id).order("created_at", desc=True).execute()
+    )
+    return response.data
+
+async def get_shop_product_images(shop_id, limit: int) -> List[Dict[str, Any]]:
+    """Returns id and image_url of a shop's newest `limit` products (no embeddings)."""
+    response = await _run(
+        lambda: supabase.table("products").select("id, image_url").eq("shop_id", shop_id)
+        .order("created_at", desc=True).limit(limit).execute()
+    )
+    return response.data
+
+async def get_shop_product_descriptions(shop_id) -> List[Dict[str, Any]]:
+    """Returns id and description of every product in a shop (no embeddings)."""
+    response = await _run(lambda: supabase.table("products").select("id, description").eq("shop_id", shop_id).execute())
+    return response.data
+
+async def get_shop_product_vectors(shop_id, page_size: int = 1000) -> List[Dict[str, Any]]:
+    """
+    Returns every product of a shop with the columns match_products returns plus its embedding,
+    paged so PostgREST's max-rows limit cannot truncate large catalogs.
+    """
+    rows: List[Dict[str, Any]] = []
+    while True:
+        start = len(rows)
+        response = await _run(
+            lambda: supabase.table("products")
+            .select("id, shop_id, name, price, image_url, description, embedding")
+            .eq("shop_id", shop_id)
+            .order("id")
+            .range(start, start + page_size - 1)
+            .execute()
+        )
+        rows.extend(response.data)
+        if len(response.data) < page_size:
+            return rows
+
+async def update_product(product_id, data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    response = await _run(lambda: supabase.table("products").update(data).eq("id", product_id).execute())
+    return response.data
+
+async def match_products(params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Runs the match_products vector search RPC (query_embedding, match_threshold, filter_page_id)."""
+    response = await _run(lambda: supabase.rpc("match_products", params).execute())
+    return response.data or []
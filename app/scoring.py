@@ -0,0 +1,178 @@
+import os
+import tempfile
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+# Storage precisions for the screening copy of a catalog
+PRECISIONS = ("int8", "float16", "float32")
+
+# Unit roundoff of float16 (10 explicit mantissa bits) and float32
+_F16_EPS = 2.0 ** -11
+_F32_EPS = 2.0 ** -24
+
+class _GrowableMatrix:
+    """Row-appendable 2-D array with amortized O(1) appends (capacity doubles when full)."""
+
+    def __init__(self, data: np.ndarray):
+        self._data = data
+        self.size = data.shape[0]
+
+    @property
+    def rows(self) -> np.ndarray:
+        return self._data[:self.size]
+
+    def append(self, row: np.ndarray):
+        if self.size == self._data.shape[0]:
+            grown = np.empty((max(self.size * 2, 16),) + self._data.shape[1:], dtype=self._data.dtype)
+            grown[:self.size] = self._data[:self.size]
+            self._data = grown
+        self._data[self.size] = row
+        self.size += 1
+
+    @property
+    def nbytes(self) -> int:
+        return self._data.nbytes
+
+class _RerankStore:
+    """
+    Original float32 rows used to confirm candidates exactly. The rows present at build time are
+    written to an unlinked temporary file and memory-mapped, so they live in reclaimable page
+    cache instead of the worker's heap; rows appended later are kept in memory.
+    """
+
+    def __init__(self, vectors: np.ndarray, directory: Optional[str]):
+        self._mapped: np.ndarray = vectors
+        if directory and len(vectors):
+            os.makedirs(directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=directory, suffix=".f32") as handle:
+                vectors.tofile(handle)
+                handle.flush()
+                self._mapped = np.memmap(handle.name, dtype=np.float32, mode="r", shape=vectors.shape)
+            # The mapping outlives the file name, so nothing is left on disk once the catalog is dropped
+        self._tail = _GrowableMatrix(np.empty((0, vectors.shape[1]), dtype=np.float32))
+
+    def append(self, vector: np.ndarray):
+        self._tail.append(vector)
+
+    def take(self, indices: np.ndarray) -> np.ndarray:
+        split = self._mapped.shape[0]
+        head = indices[indices < split]
+        tail = indices[indices >= split] - split
+        rows = np.empty((indices.size, self._mapped.shape[1]), dtype=np.float64)
+        rows[indices < split] = self._mapped[head]
+        rows[indices >= split] = self._tail.rows[tail]
+        return rows
+
+    @property
+    def memory_bytes(self) -> int:
+        mapped = 0 if isinstance(self._mapped, np.memmap) else self._mapped.nbytes
+        return mapped + self._tail.nbytes
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+class QuantizedCatalog:
+    """
+    Cosine top-k over a catalog whose normalized rows are stored as int8 (with a float32 scale
+    per row), float16 or float32.
+
+    Every row is screened with one matrix-vector product over the compact copy. Each screened score
+    carries a worst-case quantization/rounding bound, so rows that cannot clear the threshold or
+    reach the top k are discarded safely, and the few survivors are re-scored exactly from the
+    original float32 vectors in float64. The result therefore equals an exact search (and
+    match_products) rather than approximating it.
+    """
+
+    def __init__(self, vectors: np.ndarray, precision: str = "int8", rerank_dir: Optional[str] = None,
+                 chunk_rows: int = 256):
+        if precision not in PRECISIONS:
+            raise ValueError(f"precision must be one of {PRECISIONS}, got {precision!r}")
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        # Explicit width: an empty catalog (a shop with no products yet) is (0, dim), not unshaped
+        vectors = vectors.reshape(-1, vectors.shape[-1])
+        self.precision = precision
+        self.dim = vectors.shape[1]
+        self.chunk_rows = chunk_rows
+        data, scales = self._quantize(_normalize(vectors))
+        self._data = _GrowableMatrix(data)
+        self._scales = _GrowableMatrix(scales)
+        self._exact = _RerankStore(vectors, rerank_dir)
+
+    def __len__(self) -> int:
+        return self._data.size
+
+    def _quantize(self, normalized: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        if self.precision == "int8":
+            scales = np.abs(normalized).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            data = np.clip(np.rint(normalized / scales[:, None]), -127, 127).astype(np.int8)
+            return data, scales.astype(np.float32)
+        ones = np.ones(normalized.shape[0], dtype=np.float32)
+        return normalized.astype(np.float16 if self.precision == "float16" else np.float32), ones
+
+    def append(self, vector: np.ndarray):
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, self.dim)
+        data, scales = self._quantize(_normalize(vector))
+        self._data.append(data[0])
+        self._scales.append(scales[0])
+        self._exact.append(vector[0])
+
+    def screen(self, query: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns (approximate scores, per-row error bound) for a normalized float32 query."""
+        data, scales = self._data.rows, self._scales.rows
+        scores = np.empty(data.shape[0], dtype=np.float32)
+        # Widen one cache-sized chunk at a time so the temporary float32 copy stays small
+        for start in range(0, data.shape[0], self.chunk_rows):
+            chunk = data[start:start + self.chunk_rows]
+            scores[start:start + chunk.shape[0]] = chunk.astype(np.float32, copy=False) @ query
+        scores *= scales
+
+        # Float32 accumulation over `dim` terms of a unit-norm product, plus the final scale multiply
+        slack = (self.dim + 2) * _F32_EPS * 2
+        if self.precision == "int8":
+            # Each stored element is off by at most half a quantization step
+            bound = scales * (0.5 * float(np.abs(query).sum())) + slack
+        elif self.precision == "float16":
+            # Relative rounding per element (sum |q_i x_i| <= 1 for unit vectors), absolute for subnormals
+            bound = np.full_like(scores, _F16_EPS + 2.0 ** -25 * float(np.abs(query).sum()) + slack)
+        else:
+            bound = np.full_like(scores, slack)
+        return scores, bound
+
+    def search(self, query: np.ndarray, threshold: float, k: int) -> List[Tuple[int, float]]:
+        """Returns up to k (row, similarity) pairs with similarity > threshold, best first."""
+        if not len(self) or k <= 0:
+            return []
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        query_norm = float(np.linalg.norm(query.astype(np.float64)))
+        if query_norm == 0:
+            return []
+        scores, bound = self.screen((query / query_norm).astype(np.float32))
+
+        candidates = np.nonzero(scores + bound > threshold)[0]
+        if candidates.size > k:
+            # Anything whose best case falls below the k-th best worst case cannot be in the top k
+            lower = scores[candidates] - bound[candidates]
+            kth_lower = lower[np.argpartition(-lower, k - 1)[k - 1]]
+            candidates = candidates[scores[candidates] + bound[candidates] >= kth_lower]
+
+        # Exact cosine from the original vectors, in float64
+        rows = self._exact.take(candidates)
+        norms = np.linalg.norm(rows, axis=1)
+        norms[norms == 0] = np.inf
+        exact = (rows @ query.astype(np.float64)) / (norms * query_norm)
+
+        keep = exact > threshold
+        candidates, exact = candidates[keep], exact[keep]
+        order = np.lexsort((candidates, -exact))[:k]
+        return [(int(candidates[i]), float(exact[i])) for i in order]
+
+    def memory_bytes(self) -> dict:
+        """Heap bytes held: the screening copy (with scales) and in-memory exact rows."""
+        return {
+            "screening": self._data.nbytes + self._scales.nbytes,
+            "exact": self._exact.memory_bytes,
+        }
@@ -1,9 +1,13 @@
 from cryptography.fernet import Fernet
+from app.cache import TTLCache
 from app.config import get_settings
 
 settings = get_settings()
 cipher_suite = Fernet(settings.ENCRYPTION_KEY)
 
+# Decrypted page tokens keyed by their ciphertext. Memory only, never persisted.
+_token_cache = TTLCache(maxsize=settings.TOKEN_CACHE_MAX_SIZE, ttl=settings.TOKEN_CACHE_TTL)
+
 def encrypt_token(token: str) -> str:
     """Encrypts a token using Fernet symmetric encryption."""
     if not token:
@@ -14,4 +18,21 @@ def decrypt_token(token: str) -> str:
     """Decrypts a token using Fernet symmetric encryption."""
     if not token:
         return ""
-    return cipher_suite.decrypt(token.encode()).decode()
+    if not settings.TOKEN_CACHE_ENABLED:
+        return cipher_suite.decrypt(token.encode()).decode()
+    plaintext = _token_cache.get(token)
+    if plaintext is None:
+        plaintext = cipher_suite.decrypt(token.encode()).decode()
+        _token_cache.set(token, plaintext)
+    return plaintext
+
+def forget_token(token: str):
+    """Removes one ciphertext from the decrypted-token cache."""
+    if token:
+        _token_cache.pop(token)
+
+def clear_token_cache():
+    _token_cache.clear()
+
+def token_cache_stats() -> dict:
+    return {"enabled": settings.TOKEN_CACHE_ENABLED, **_token_cache.stats()}
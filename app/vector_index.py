@@ -0,0 +1,179 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from app import repository
+from app.concurrency import run_image_task
+from app.config import get_settings
+from app.scoring import QuantizedCatalog
+
+settings = get_settings()
+logger = logging.getLogger("OmniVision")
+
+# Columns match_products returns, minus the computed similarity
+RESULT_COLUMNS = ("id", "shop_id", "name", "price", "image_url", "description")
+MATCH_COUNT = 5 # match_products' default match_count
+EMBEDDING_DIM = 768
+
+def parse_embedding(value) -> Optional[np.ndarray]:
+    """PostgREST returns pgvector columns as text ("[0.1,0.2,...]"); accept lists too."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+class ShopIndex:
+    """
+    Exact cosine search over one shop's catalog, backed by a QuantizedCatalog (compact screening
+    copy plus exact rerank). Same semantics as match_products: similarity = 1 - cosine distance,
+    keep rows with similarity > threshold, best first, at most `k`.
+    """
+
+    def __init__(self, rows: List[dict], vectors: List[np.ndarray]):
+        self.rows = rows
+        self.catalog = QuantizedCatalog(
+            np.vstack(vectors) if vectors else np.zeros((0, EMBEDDING_DIM), dtype=np.float32),
+            precision=settings.VECTOR_INDEX_PRECISION,
+            rerank_dir=settings.VECTOR_INDEX_RERANK_DIR or None,
+        )
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, row: dict, vector: np.ndarray):
+        self.catalog.append(vector)
+        self.rows.append(row)
+
+    def search(self, query: np.ndarray, threshold: float, k: int) -> List[dict]:
+        return [{**self.rows[i], "similarity": score} for i, score in self.catalog.search(query, threshold, k)]
+
+class HnswShopIndex:
+    """Approximate (HNSW) cosine search for large catalogs; needs the optional hnswlib package."""
+
+    def __init__(self, rows: List[dict], vectors: List[np.ndarray]):
+        import hnswlib
+        self.rows = rows
+        dim = vectors[0].shape[0]
+        self._index = hnswlib.Index(space="cosine", dim=dim)
+        self._index.init_index(max_elements=max(len(rows) * 2, 1024), ef_construction=200, M=16)
+        self._index.add_items(np.vstack(vectors), np.arange(len(rows)))
+        self._index.set_ef(max(settings.VECTOR_INDEX_HNSW_EF, 64))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, row: dict, vector: np.ndarray):
+        if len(self.rows) >= self._index.get_max_elements():
+            self._index.resize_index(len(self.rows) * 2)
+        self._index.add_items(vector[None, :], np.array([len(self.rows)]))
+        self.rows.append(row)
+
+    def search(self, query: np.ndarray, threshold: float, k: int) -> List[dict]:
+        if not self.rows:
+            return []
+        labels, distances = self._index.knn_query(query[None, :], k=min(k, len(self.rows)))
+        results = []
+        for label, distance in zip(labels[0], distances[0]):
+            similarity = 1.0 - float(distance)
+            if similarity > threshold:
+                results.append({**self.rows[int(label)], "similarity": similarity})
+        return results
+
+def _build_index(rows: List[dict]):
+    """Blocking: parses the vectors and builds the index type that suits the catalog size."""
+    kept, vectors = [], []
+    for row in rows:
+        vector = parse_embedding(row.get("embedding"))
+        if vector is None:
+            continue
+        kept.append({column: row.get(column) for column in RESULT_COLUMNS})
+        vectors.append(vector)
+    if len(kept) >= settings.VECTOR_INDEX_HNSW_MIN_ROWS:
+        try:
+            return HnswShopIndex(kept, vectors)
+        except ImportError:
+            logger.warning("hnswlib is not installed; using the exact NumPy index for a large catalog")
+    return ShopIndex(kept, vectors)
+
+class VectorIndexManager:
+    """
+    Per-worker, lazily loaded product-embedding indexes, one per shop (LRU over VECTOR_INDEX_MAX_SHOPS).
+    Products added through this worker are appended immediately; an index is rebuilt after
+    VECTOR_INDEX_TTL so changes made through other workers are picked up.
+    """
+
+    def __init__(self, max_shops: int, ttl: float):
+        self.max_shops = max_shops
+        self.ttl = ttl
+        self.hits = 0
+        self.loads = 0
+        self._indexes: "OrderedDict[str, tuple]" = OrderedDict() # page_id -> (index, loaded_at)
+        self._loading: Dict[str, asyncio.Task] = {}
+        self._generation: Dict[str, int] = {} # Bumped by writes, so a load that raced one is not trusted
+
+    async def _load(self, key: str):
+        generation = self._generation.get(key, 0)
+        rows = await repository.get_shop_product_vectors(int(key))
+        index = await run_image_task(_build_index, rows)
+        self.loads += 1
+        # If a product was added meanwhile the rows may predate it: serve this result, reload next time
+        loaded_at = time.monotonic() if self._generation.get(key, 0) == generation else float("-inf")
+        self._indexes[key] = (index, loaded_at)
+        self._indexes.move_to_end(key)
+        while len(self._indexes) > self.max_shops:
+            self._indexes.popitem(last=False)
+        logger.info("Loaded vector index for shop %s (%s products, %s)", key, len(index), type(index).__name__)
+        return index
+
+    async def get_index(self, page_id):
+        key = str(page_id)
+        entry = self._indexes.get(key)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            self._indexes.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        # One load per shop at a time; concurrent searches wait for it
+        task = self._loading.get(key)
+        if task is None:
+            task = self._loading[key] = asyncio.create_task(self._load(key))
+            task.add_done_callback(lambda _: self._loading.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def search(self, page_id, query_embedding: List[float], threshold: float, k: int) -> List[dict]:
+        index = await self.get_index(page_id)
+        return index.search(np.asarray(query_embedding, dtype=np.float32), threshold, k)
+
+    def add_product(self, row: dict):
+        """Appends a freshly inserted product to its shop's index, if that index is loaded."""
+        key = str(row.get("shop_id"))
+        self._generation[key] = self._generation.get(key, 0) + 1
+        entry = self._indexes.get(key)
+        vector = parse_embedding(row.get("embedding"))
+        if entry is not None and vector is not None:
+            entry[0].add({column: row.get(column) for column in RESULT_COLUMNS}, vector)
+
+    def invalidate(self, page_id):
+        key = str(page_id)
+        self._generation[key] = self._generation.get(key, 0) + 1
+        self._indexes.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": settings.VECTOR_INDEX_ENABLED,
+            "shops": len(self._indexes),
+            "products": sum(len(index) for index, _ in self._indexes.values()),
+            "memory_bytes": sum(
+                sum(index.catalog.memory_bytes().values())
+                for index, _ in self._indexes.values() if isinstance(index, ShopIndex)
+            ),
+            "hits": self.hits,
+            "loads": self.loads,
+        }
+
+vector_index = VectorIndexManager(max_shops=settings.VECTOR_INDEX_MAX_SHOPS, ttl=settings.VECTOR_INDEX_TTL)
@@ -0,0 +1,119 @@
+"""
+Compares catalog scoring approaches on a synthetic shop catalog:
+
+  - baseline: float64 Python lists, scored row by row (what a naive in-process search looks like)
+  - app.scoring.QuantizedCatalog at float32, float16 and int8 precision
+
+For each it reports the heap held by the catalog (memory-mapped rows live in page cache and are not
+counted), queries per second, and whether the top-k at the match threshold is identical to the
+exact float64 answer.
+
+Usage: python benchmarks/bench_scoring.py [--rows 5000] [--dim 768] [--queries 200]
+"""
+import argparse
+import math
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# Run from the repository root without installing the package
+sys.path.append(os.getcwd())
+
+from app.scoring import QuantizedCatalog  # noqa: E402
+
+THRESHOLD = 0.70 # handle_image_search's match_threshold
+TOP_K = 5 # match_products' default match_count
+
+def make_catalog(rows: int, dim: int, seed: int = 0):
+    """Products grouped around a few hundred "styles", so queries have several neighbours above 0.70."""
+    rng = np.random.default_rng(seed)
+    styles = rng.normal(size=(max(rows // 20, 1), dim))
+    members = styles[rng.integers(0, len(styles), size=rows)]
+    vectors = members + rng.normal(scale=rng.uniform(0.3, 1.2, size=(rows, 1)), size=(rows, dim))
+    queries = styles[rng.integers(0, len(styles), size=512)] + rng.normal(scale=0.5, size=(512, dim))
+    return vectors.astype(np.float32), queries.astype(np.float32)
+
+def baseline_search(catalog, norms, query, threshold, k):
+    query_norm = math.sqrt(sum(q * q for q in query))
+    scored = []
+    for i, (row, norm) in enumerate(zip(catalog, norms)):
+        score = sum(a * b for a, b in zip(row, query)) / (norm * query_norm)
+        if score > threshold:
+            scored.append((score, i))
+    scored.sort(key=lambda item: (-item[0], item[1]))
+    return [(i, score) for score, i in scored[:k]]
+
+def measure(build):
+    """Returns what build() returned and the Python heap it still holds."""
+    tracemalloc.start()
+    obj = build()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, held
+
+def qps(search, queries):
+    start = time.perf_counter()
+    results = [search(q) for q in queries]
+    return len(queries) / (time.perf_counter() - start), results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--baseline-queries", type=int, default=10, help="The baseline is slow; time fewer queries")
+    args = parser.parse_args()
+
+    vectors, queries = make_catalog(args.rows, args.dim)
+    queries = queries[:args.queries]
+
+    # Exact reference answers in float64
+    exact_matrix = vectors.astype(np.float64)
+    exact_matrix /= np.linalg.norm(exact_matrix, axis=1, keepdims=True)
+    def reference(query):
+        q = query.astype(np.float64)
+        scores = exact_matrix @ (q / np.linalg.norm(q))
+        keep = np.nonzero(scores > THRESHOLD)[0]
+        order = np.lexsort((keep, -scores[keep]))[:TOP_K]
+        return [int(keep[i]) for i in order]
+    expected = [reference(q) for q in queries]
+
+    print(f"catalog: {args.rows} rows x {args.dim} dims, threshold {THRESHOLD}, top {TOP_K}")
+    print(f"{'engine':<20}{'heap MB':>10}{'QPS':>12}{'exact':>8}")
+
+    def build_baseline():
+        catalog = [[float(x) for x in row] for row in vectors]
+        norms = [math.sqrt(sum(x * x for x in row)) for row in catalog]
+        return catalog, norms
+    (catalog, norms), held = measure(build_baseline)
+    subset = queries[:args.baseline_queries]
+    rate, results = qps(lambda q: baseline_search(catalog, norms, q.tolist(), THRESHOLD, TOP_K), subset)
+    same = all([i for i, _ in got] == want for got, want in zip(results, expected))
+    print(f"{'float64 lists':<20}{held / 2**20:>10.1f}{rate:>12.1f}{str(same):>8}")
+    del catalog, norms
+
+    for precision in ("float32", "float16", "int8"):
+        for rerank_dir in (None, "data/bench_scoring"):
+            engine = QuantizedCatalog(vectors.copy(), precision=precision, rerank_dir=rerank_dir)
+            held = sum(engine.memory_bytes().values())
+            rate, results = qps(lambda q: engine.search(q, THRESHOLD, TOP_K), queries)
+            same = all([i for i, _ in got] == want for got, want in zip(results, expected))
+            label = precision + (" +mmap" if rerank_dir else "")
+            print(f"{label:<20}{held / 2**20:>10.1f}{rate:>12.1f}{str(same):>8}")
+            del engine
+
+    # A shop's index starts empty and is filled by add_product; it must answer the same as a bulk build
+    engine = QuantizedCatalog(np.zeros((0, args.dim), dtype=np.float32))
+    for row in vectors:
+        engine.append(row)
+    results = [engine.search(q, THRESHOLD, TOP_K) for q in queries]
+    same = all([i for i, _ in got] == want for got, want in zip(results, expected))
+    print(f"{'int8 grown from empty':<20}{sum(engine.memory_bytes().values()) / 2**20:>10.1f}{'-':>12}{str(same):>8}")
+    if not same:
+        sys.exit("int8 catalog grown from empty does not match the exact answer")
+
+if __name__ == "__main__":
+    main()
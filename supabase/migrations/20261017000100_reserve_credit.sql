@@ -0,0 +1,15 @@
+-- Atomic check-and-deduct for image search credits.
+-- Decrements users.credits by p_amount only if the balance covers it, in a single
+-- statement, so concurrent searches for the same owner cannot lose deductions.
+-- Returns the new balance, or NULL if the user does not exist or has too few credits.
+
+create or replace function reserve_credit(p_owner_id text, p_amount integer default 1)
+returns integer
+language sql
+as $$
+    update users
+       set credits = credits - p_amount
+     where facebook_user_id = p_owner_id
+       and credits >= p_amount
+    returning credits;
+$$;
@@ -0,0 +1,42 @@
+-- Block reservations for the per-worker credit ledger (app/credit_ledger.py).
+-- A worker reserves up to p_max credits at once and spends them locally,
+-- then hands back whatever it did not use in one batched call.
+
+-- Deducts min(balance, p_max) from the owner and returns the amount granted
+-- (0 if the user does not exist or has no credits left).
+create or replace function reserve_credits_block(p_owner_id text, p_max integer)
+returns integer
+language plpgsql
+as $$
+declare
+    v_balance integer;
+    v_granted integer;
+begin
+    select credits into v_balance
+      from users
+     where facebook_user_id = p_owner_id
+       for update;
+
+    if v_balance is null or v_balance <= 0 then
+        return 0;
+    end if;
+
+    v_granted := least(v_balance, p_max);
+    update users
+       set credits = credits - v_granted
+     where facebook_user_id = p_owner_id;
+    return v_granted;
+end;
+$$;
+
+-- Returns unused allowances in one statement.
+-- p_deltas is a JSON object mapping facebook_user_id -> credits to add back.
+create or replace function release_credits(p_deltas jsonb)
+returns void
+language sql
+as $$
+    update users u
+       set credits = u.credits + d.value::integer
+      from jsonb_each_text(p_deltas) d
+     where u.facebook_user_id = d.key;
+$$;
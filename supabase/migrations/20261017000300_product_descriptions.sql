@@ -0,0 +1,58 @@
+-- Store the Gemini product description next to the embeddings, and return it from
+-- match_products so the text-first verification tier needs no extra query.
+--
+-- The earlier match_products definition was created outside this repository. This version keeps
+-- its call signature and threshold semantics (cosine similarity > match_threshold, best first).
+-- Both query vectors are identical today, so ranking on siglip_embedding alone gives the same order.
+
+alter table products add column if not exists description text;
+
+-- The return type changes, which CREATE OR REPLACE cannot do. The existing signature is not
+-- known here (and there may be more than one overload), so drop every match_products by name.
+do $$
+declare
+    r record;
+begin
+    for r in
+        select p.oid::regprocedure as signature
+          from pg_proc p
+         where p.proname = 'match_products'
+           and p.pronamespace = 'public'::regnamespace
+    loop
+        execute format('drop function %s', r.signature);
+    end loop;
+end;
+$$;
+
+create function match_products(
+    query_siglip vector(768),
+    query_dino vector(768),
+    match_threshold float,
+    filter_page_id bigint,
+    match_count integer default 5
+)
+returns table (
+    id bigint,
+    shop_id bigint,
+    name text,
+    price numeric,
+    image_url text,
+    description text,
+    similarity float
+)
+language sql
+stable
+as $$
+    select p.id,
+           p.shop_id,
+           p.name,
+           p.price,
+           p.image_url,
+           p.description,
+           1 - (p.siglip_embedding <=> query_siglip) as similarity
+      from products p
+     where p.shop_id = filter_page_id
+       and 1 - (p.siglip_embedding <=> query_siglip) > match_threshold
+     order by p.siglip_embedding <=> query_siglip
+     limit match_count;
+$$;
@@ -0,0 +1,98 @@
+-- Products store one embedding instead of two identical ones (siglip_embedding and dino_embedding
+-- always held the same Gemini text embedding). This halves vector storage, index memory and the
+-- match_products request payload.
+
+alter table products add column if not exists embedding vector(768);
+
+-- Backfill existing rows, then free the duplicated columns
+update products
+   set embedding = coalesce(siglip_embedding, dino_embedding)
+ where embedding is null;
+
+alter table products alter column siglip_embedding drop not null;
+alter table products alter column dino_embedding drop not null;
+
+update products
+   set siglip_embedding = null,
+       dino_embedding = null
+ where siglip_embedding is not null or dino_embedding is not null;
+
+-- Workers still running the previous release write the old columns; move their vector over
+create or replace function products_single_embedding()
+returns trigger
+language plpgsql
+as $$
+begin
+    if new.embedding is null then
+        new.embedding := coalesce(new.siglip_embedding, new.dino_embedding);
+    end if;
+    new.siglip_embedding := null;
+    new.dino_embedding := null;
+    return new;
+end;
+$$;
+
+drop trigger if exists products_single_embedding on products;
+create trigger products_single_embedding
+    before insert or update on products
+    for each row execute function products_single_embedding();
+
+create index if not exists products_embedding_idx
+    on products using hnsw (embedding vector_cosine_ops);
+
+-- Single-vector search. Same threshold semantics and columns as before.
+create or replace function match_products(
+    query_embedding vector(768),
+    match_threshold float,
+    filter_page_id bigint,
+    match_count integer default 5
+)
+returns table (
+    id bigint,
+    shop_id bigint,
+    name text,
+    price numeric,
+    image_url text,
+    description text,
+    similarity float
+)
+language sql
+stable
+as $$
+    select p.id,
+           p.shop_id,
+           p.name,
+           p.price,
+           p.image_url,
+           p.description,
+           1 - (p.embedding <=> query_embedding) as similarity
+      from products p
+     where p.shop_id = filter_page_id
+       and 1 - (p.embedding <=> query_embedding) > match_threshold
+     order by p.embedding <=> query_embedding
+     limit match_count;
+$$;
+
+-- Previous signature, kept while old workers drain; PostgREST tells the two apart by argument names.
+-- Drop it in a later migration once every worker runs the single-vector release.
+create or replace function match_products(
+    query_siglip vector(768),
+    query_dino vector(768),
+    match_threshold float,
+    filter_page_id bigint,
+    match_count integer default 5
+)
+returns table (
+    id bigint,
+    shop_id bigint,
+    name text,
+    price numeric,
+    image_url text,
+    description text,
+    similarity float
+)
+language sql
+stable
+as $$
+    select * from match_products(query_siglip, match_threshold, filter_page_id, match_count);
+$$;
@@ -0,0 +1,35 @@
+-- Image-search credit reservation keyed by page instead of owner, so the webhook path
+-- can charge the credit while the shop row is still being fetched.
+-- Resolves shops.owner_id and deducts p_amount from that user in one call.
+--   * no row            -> unknown page, or the owner is missing / has too few credits
+--   * owner_id NULL     -> the shop has no owner and is not metered (nothing deducted)
+--   * owner_id, credits -> deducted; credits is the new balance
+
+create or replace function reserve_credit_for_page(p_page_id bigint, p_amount integer default 1)
+returns table (owner_id text, credits integer)
+language plpgsql
+as $$
+declare
+    v_owner_id text;
+begin
+    select s.owner_id into v_owner_id
+      from shops s
+     where s.page_id = p_page_id;
+
+    if not found then
+        return;
+    end if;
+
+    if v_owner_id is null then
+        return query select null::text, null::integer;
+        return;
+    end if;
+
+    return query
+        update users u
+           set credits = u.credits - p_amount
+         where u.facebook_user_id = v_owner_id
+           and u.credits >= p_amount
+        returning u.facebook_user_id, u.credits;
+end;
+$$;
@@ -0,0 +1,33 @@
+-- Block reservations that keep an owner's last credits out of any single worker (app/credit_ledger.py).
+-- A worker used to be able to take min(balance, p_max), so the first worker to ask could
+-- hold an owner's last credits while the other workers refused searches. A block of p_max is
+-- now only granted while the balance covers one for each of the p_workers workers; below that
+-- nothing is granted and the worker falls back to reserve_credit, one atomic credit per search.
+
+drop function if exists reserve_credits_block(text, integer);
+
+create or replace function reserve_credits_block(p_owner_id text, p_max integer, p_workers integer default 1)
+returns integer
+language plpgsql
+as $$
+declare
+    v_balance integer;
+    v_granted integer;
+begin
+    select credits into v_balance
+      from users
+     where facebook_user_id = p_owner_id
+       for update;
+
+    if v_balance is null or v_balance < p_max * greatest(p_workers, 1) then
+        return 0;
+    end if;
+
+    v_granted := p_max;
+
+    update users
+       set credits = credits - v_granted
+     where facebook_user_id = p_owner_id;
+    return v_granted;
+end;
+$$;